@@ -14,6 +14,12 @@ export const META_SHUTTER = 'shutter';
 export const META_APERTURE = 'aperture';
 export const META_ISO = 'iso';
 export const META_ZOOM = 'zoom';
+export const META_PREVIEWS = 'previews';
+export const META_FILE = 'file';
+export const META_FORMATS = 'formats';
+export const META_SPRITE = 'sprite';
+export const META_X = 'x';
+export const META_Y = 'y';
 
 export const ROOT_CAPTION = 'Gallery';
 
@@ -1,4 +1,4 @@
-import { META_APERTURE, META_CAPTION, META_COPYRIGHT, META_DATE, META_HEIGHT, META_ISO, META_ITEMS, META_LAT, META_LON, META_SHUTTER, META_WIDTH, META_ZOOM } from './constants';
+import { META_APERTURE, META_CAPTION, META_COPYRIGHT, META_DATE, META_FILE, META_FORMATS, META_HEIGHT, META_ISO, META_ITEMS, META_LAT, META_LON, META_PREVIEWS, META_SHUTTER, META_SPRITE, META_WIDTH, META_X, META_Y, META_ZOOM } from './constants';
 
 export type Dim2D = {
     w: number,
@@ -37,23 +37,38 @@ export type AlbumListing = {
     entries: ListingEntry[],
 }
 
+export type MetaSprite = {
+    [META_FILE]: string,
+    [META_X]: number,
+    [META_Y]: number,
+}
+
 export type MetaItems = {
     [key: string]: {
         [META_CAPTION]?: string,
         [META_DATE]?: string,
+        [META_SPRITE]?: MetaSprite,
     }
 }
 
+export type MetaPreview = {
+    [META_FILE]: string,
+    [META_WIDTH]: number,
+    [META_HEIGHT]: number,
+}
+
 export type MetaData = {
     [META_APERTURE]?: number,
     [META_CAPTION]?: string,
     [META_COPYRIGHT]?: string,
     [META_DATE]?: string,
+    [META_FORMATS]?: string[],
     [META_HEIGHT]?: number,
     [META_ISO]?: number,
     [META_ITEMS]?: MetaItems,
     [META_LAT]?: number,
     [META_LON]?: number,
+    [META_PREVIEWS]?: MetaPreview[],
     [META_SHUTTER]?: string,
     [META_WIDTH]?: number,
     [META_ZOOM]?: number,
@@ -78,12 +93,17 @@ export class Item {
     navigation: Navigation = null;
 }
 
+export class Sprite {
+    constructor(readonly url: string, readonly x: number, readonly y: number) { }
+}
+
 export class AlbumEntry {
     constructor(
         readonly type: ItemType,
         readonly caption: string,
         readonly path: string,
         readonly thumbnail: string,
+        readonly sprite: Sprite = null,
     ) { }
 }
 
@@ -95,8 +115,18 @@ export class Album extends Item {
     readonly media: AlbumEntry[] = [];
 }
 
+export class Preview {
+    constructor(readonly url: string, readonly width: number, readonly height: number) { }
+}
+
 export class Image extends Item {
-    constructor(caption: string, readonly url: string) {
+    constructor(
+        caption: string,
+        readonly url: string,
+        readonly width: number = null,
+        readonly height: number = null,
+        readonly previews: Preview[] = [],
+    ) {
         super(ItemType.IMAGE, caption);
     }
 }
@@ -119,5 +149,6 @@ export class Slab {
         readonly path: string = '',
         readonly thumbnailURL: string = '',
         readonly overlayURL: string = null,
+        readonly sprite: Sprite = null,
     ) { }
 }
@@ -60,6 +60,10 @@ export function getThumbnailURL(prefix: string, path: string) {
     return prefix + urlencodeSegments(WAG_DIR + '/' + getMetaId(path) + '/' + THUMBNAIL_FILE);
 }
 
+export function getMetaFileURL(prefix: string, path: string, file: string) {
+    return prefix + urlencodeSegments(WAG_DIR + '/' + getMetaId(path) + '/' + file);
+}
+
 export function getMetaURL(prefix: string, path: string) {
     return prefix + urlencodeSegments(WAG_DIR + '/' + getMetaId(path) + '/' + METADATA_FILE);
 }
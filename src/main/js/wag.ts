@@ -1,7 +1,7 @@
-import { META_CAPTION, META_ITEMS, PATHS, ROOT_CAPTION } from './constants';
-import { Album, AlbumEntry, AlbumListing, Image, Item, ItemType, ListingEntryType, MetaData, MetaItems, Video, VideoEntry } from './models';
+import { META_CAPTION, META_FILE, META_HEIGHT, META_ITEMS, META_PREVIEWS, META_SPRITE, META_WIDTH, META_X, META_Y, PATHS, ROOT_CAPTION } from './constants';
+import { Album, AlbumEntry, AlbumListing, Image, Item, ItemType, ListingEntryType, MetaData, MetaItems, Preview, Sprite, Video, VideoEntry } from './models';
 import { getAlbumListing, getContent } from './service';
-import { basename, dirname, filename, getMediaURL, getMetaId, getMetaURL, getNavigation, getThumbnailURL, guessMediaType, urlencodeSegments, videoMIME } from './utils';
+import { basename, dirname, filename, getMediaURL, getMetaId, getMetaURL, getNavigation, getMetaFileURL, getThumbnailURL, guessMediaType, urlencodeSegments, videoMIME } from './utils';
 
 class ItemGrouping {
     readonly [ItemType.ALBUM] = <string[]>[];
@@ -24,6 +24,14 @@ function albumFromListing(path: string, listing: AlbumListing, meta: MetaData =
         albumCaption = ROOT_CAPTION;
     }
     let album = new Album(albumCaption);
+    // the thumbnails are taken from the sprite sheets of the album when it has them
+    let getSprite = (itemId: string) => {
+        if (!(itemId in itemsMeta) || !(META_SPRITE in itemsMeta[itemId])) {
+            return null;
+        }
+        let sprite = itemsMeta[itemId][META_SPRITE];
+        return new Sprite(getMetaFileURL(listing.mediaURL, path, sprite[META_FILE]), sprite[META_X], sprite[META_Y]);
+    };
     let groups = new Map<string, ItemGrouping>();
     for (let entry of listing.entries) {
         let key = filename(entry.path);
@@ -51,20 +59,20 @@ function albumFromListing(path: string, listing: AlbumListing, meta: MetaData =
             let itemId = getMetaId(entry);
             let caption = itemId in itemsMeta && META_CAPTION in itemsMeta[itemId] ?
                 itemsMeta[itemId][META_CAPTION] : basename(entry);
-            album.albums.push(new AlbumEntry(ItemType.ALBUM, caption, entry, getThumbnailURL(listing.mediaURL, entry)));
+            album.albums.push(new AlbumEntry(ItemType.ALBUM, caption, entry, getThumbnailURL(listing.mediaURL, entry), getSprite(itemId)));
         }
         if (group[ItemType.VIDEO].length > 0) {
             let entry = group[ItemType.VIDEO][0];
             let itemId = getMetaId(entry);
             let caption = itemId in itemsMeta && META_CAPTION in itemsMeta[itemId] ?
                 itemsMeta[itemId][META_CAPTION] : basename(entry);
-            album.media.push(new AlbumEntry(ItemType.VIDEO, caption, entry, getThumbnailURL(listing.mediaURL, entry)));
+            album.media.push(new AlbumEntry(ItemType.VIDEO, caption, entry, getThumbnailURL(listing.mediaURL, entry), getSprite(itemId)));
         } else {
             for (let entry of group[ItemType.IMAGE]) {
                 let itemId = getMetaId(entry);
                 let caption = itemId in itemsMeta && META_CAPTION in itemsMeta[itemId] ?
                     itemsMeta[itemId][META_CAPTION] : basename(entry);
-                album.media.push(new AlbumEntry(ItemType.IMAGE, caption, entry, getThumbnailURL(listing.mediaURL, entry)));
+                album.media.push(new AlbumEntry(ItemType.IMAGE, caption, entry, getThumbnailURL(listing.mediaURL, entry), getSprite(itemId)));
             }
         }
     });
@@ -101,7 +109,12 @@ function itemFromListing(path: string, listing: AlbumListing, meta: MetaData = n
         item.navigation = getNavigation(mediaEntries, e => filename(e) === itemName, path4Nav);
         return item;
     } else {
-        let item = new Image(itemCaption, getMediaURL(listing.mediaURL, path));
+        let previews: Preview[] = [];
+        if (meta && META_PREVIEWS in meta) {
+            previews = meta[META_PREVIEWS].map(p => new Preview(getMetaFileURL(listing.mediaURL, path, p[META_FILE]), p[META_WIDTH], p[META_HEIGHT]));
+        }
+        let item = new Image(itemCaption, getMediaURL(listing.mediaURL, path),
+            meta ? meta[META_WIDTH] : null, meta ? meta[META_HEIGHT] : null, previews);
         item.navigation = getNavigation(mediaEntries, e => e === path, path4Nav);
         return item;
     }
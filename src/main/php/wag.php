@@ -117,6 +117,12 @@ class LocalGallery implements Gallery
         if (!is_dir($localPath)) {
             serveError(404);
         }
+        // the generator leaves out the time when a change within the same second could go unnoticed,
+        // filemtime having whole seconds only
+        $listing = WAG::readListing($safePath);
+        if ($listing !== null && isset($listing['mtimeNs']) && intdiv($listing['mtimeNs'], 1000000000) === filemtime($localPath)) {
+            return WAG::getListingEntries($listing, true);
+        }
         foreach (scandir($localPath) as $file) {
             if ($file === '.' || $file === '..' || $file === '.wag') {
                 continue;
@@ -125,7 +131,7 @@ class LocalGallery implements Gallery
             $localEntry = $localPath . '/' . $file;
             if (is_file($localEntry) && WAG::isMedium($localEntry)) {
                 $type = ListingEntryType::MEDIUM;
-            } else if (is_dir($localEntry) && !is_file($localEntry . '/password.txt')) {
+            } else if (is_dir($localEntry) && !is_file($localEntry . '/' . WAG::PASSWORD_FILE)) {
                 $type = ListingEntryType::ALBUM;
             } else {
                 continue;
@@ -160,9 +166,27 @@ class B2Gallery implements Gallery
 
     public function list($pathSegments)
     {
+        $path = $this->getSafePath($pathSegments);
+        // the bucket has no folder times to tell whether the listing written by the generator is stale,
+        // so it is used only when configured, by those who upload the media together with the generator output;
+        // protected albums are listed like by b2_list_file_names
+        if (array_key_exists('listings', $this->config) && $this->config['listings'] === true) {
+            $session = curl_init($this->getMediaURL() . WAG::urlencodeSegments(WAG::WAG_DIR . '/' . md5($path) . '/' . WAG::LISTING_FILE));
+            curl_setopt($session, CURLOPT_HTTPGET, true);
+            curl_setopt($session, CURLOPT_RETURNTRANSFER, true);
+            $output = curl_exec($session);
+            $status = curl_getinfo($session, CURLINFO_RESPONSE_CODE);
+            curl_close($session);
+            if ($output !== false && $status === 200) {
+                $listing = json_decode($output, true);
+                if ($listing !== null) {
+                    return WAG::getListingEntries($listing, false);
+                }
+            }
+        }
+
         $this->b2Authorize();
 
-        $path = $this->getSafePath($pathSegments);
         $lenPath = strlen($path);
         $lenRoot = strlen($this->root);
         $prefix = $this->root . $path . ($lenPath > 0 && $path[$lenPath - 1] != '/' ? '/' : '');
@@ -252,10 +276,23 @@ class WAG
     const OTHER_EXT = array(
         'json' => 'application/json'
     );
+    // formats of thumbnails and previews besides JPEG
+    const DERIVATIVE_EXT = array(
+        'avif' => 'image/avif',
+        'webp' => 'image/webp'
+    );
     const CACHE_MAX_AGE = 3600;
     const WAG_DIR = '.wag';
     const METADATA_FILE = 'meta.json';
     const THUMBNAIL_FILE = 'tn.jpg';
+    const LISTING_FILE = 'listing.json';
+    const PASSWORD_FILE = 'password.txt';
+    const DERIVATIVE_PATTERN = '/^(tn|preview-[0-9]+|sprite-[0-9]+)\\.(jpg|webp|avif)$/';
+    const PACK_INDEX_FILE = 'thumbnails.idx';
+    const PACK_MAGIC = 'WAGP';
+    const PACK_VERSION = 1;
+    const PACK_HEADER_SIZE = 16;
+    const PACK_RECORD_SIZE = 28;
 
     private $gallery;
     private $method;
@@ -314,17 +351,30 @@ class WAG
         if (!($this->gallery instanceof LocalGallery)) {
             serveError(404, 'Not configured to serve local resources.');
         }
+        if (
+            count($this->pathSegments) === 3 && $this->pathSegments[0] === self::WAG_DIR && $this->pathSegments[2] === self::THUMBNAIL_FILE &&
+            strlen($this->pathSegments[1]) === 32 && ctype_xdigit($this->pathSegments[1]) &&
+            !is_file(implode('/', $this->pathSegments))
+        ) {
+            // the thumbnails in other formats are not packed
+            $path = self::negotiateDerivative(implode('/', $this->pathSegments));
+            if (is_file($path)) {
+                self::serveFile($path);
+            } else {
+                self::servePackedThumbnail(strtolower($this->pathSegments[1]));
+            }
+            return;
+        }
         $safePath = $this->gallery->getSafePath($this->pathSegments);
         if (!is_file($safePath)) {
             serveError(404);
         }
         if (self::isMetaPath($safePath)) {
-            switch (basename($safePath)) {
-                case self::THUMBNAIL_FILE:
-                case self::METADATA_FILE:
-                    break;
-                default:
+            if (basename($safePath) !== self::METADATA_FILE) {
+                if (!preg_match(self::DERIVATIVE_PATTERN, basename($safePath))) {
                     serveError(404);
+                }
+                $safePath = self::negotiateDerivative($safePath);
             }
         } else {
             if (!self::isMedium($safePath)) {
@@ -373,6 +423,27 @@ class WAG
             ($lenPath === $lenWagDir || $safePath[$lenWagDir] === '/');
     }
 
+    public static function readListing($safePath)
+    {
+        // the entries of an album as listed by the generator, including its protected albums,
+        // with the modification time of its folder in nanoseconds
+        $listing = @file_get_contents(self::WAG_DIR . '/' . md5($safePath) . '/' . self::LISTING_FILE);
+        return $listing !== false ? json_decode($listing, true) : null;
+    }
+
+    public static function getListingEntries($listing, $checkPasswords)
+    {
+        $entries = [];
+        foreach ($listing['entries'] as $entry) {
+            // a password protecting an album changes the time of its own folder only, so it is checked here
+            if ($checkPasswords && $entry['type'] === ListingEntryType::ALBUM && is_file($entry['path'] . '/' . self::PASSWORD_FILE)) {
+                continue;
+            }
+            array_push($entries, new ListingEntry($entry['type'], $entry['path']));
+        }
+        return $entries;
+    }
+
     public static function isMedium($path)
     {
         $ext = strtolower(pathinfo($path, PATHINFO_EXTENSION));
@@ -399,6 +470,8 @@ class WAG
         $ext = strtolower(pathinfo($safePath, PATHINFO_EXTENSION));
         if (array_key_exists($ext, self::MEDIA_EXT)) {
             $mimeType = self::MEDIA_EXT[$ext];
+        } elseif (array_key_exists($ext, self::DERIVATIVE_EXT)) {
+            $mimeType = self::DERIVATIVE_EXT[$ext];
         } elseif (array_key_exists($ext, self::OTHER_EXT)) {
             $mimeType = self::OTHER_EXT[$ext];
         } else {
@@ -416,6 +489,110 @@ class WAG
         fclose($file);
     }
 
+    private static function negotiateDerivative($path)
+    {
+        // JPEG thumbnails and previews are replaced by the first format which the client accepts
+        // of those the generator lists in the metadata next to them, in its order of preference
+        if (strtolower(pathinfo($path, PATHINFO_EXTENSION)) !== 'jpg') {
+            return $path;
+        }
+        header('Vary: Accept');
+        $meta = @file_get_contents(dirname($path) . '/' . self::METADATA_FILE);
+        $meta = $meta !== false ? json_decode($meta, true) : null;
+        if (!is_array($meta) || !array_key_exists('formats', $meta)) {
+            return $path;
+        }
+        $accepted = self::getAcceptedTypes(isset($_SERVER['HTTP_ACCEPT']) ? $_SERVER['HTTP_ACCEPT'] : '');
+        $stem = substr($path, 0, -strlen('jpg'));
+        foreach ($meta['formats'] as $mimeType) {
+            $ext = array_search($mimeType, self::DERIVATIVE_EXT, true);
+            if ($ext === false) {
+                // JPEG comes last
+                break;
+            }
+            if (in_array($mimeType, $accepted, true) && is_file($stem . $ext)) {
+                return $stem . $ext;
+            }
+        }
+        return $path;
+    }
+
+    private static function getAcceptedTypes($accept)
+    {
+        // the media types named in an Accept header, without those refused with q=0;
+        // wildcards do not tell whether a client decodes a format
+        $types = [];
+        foreach (explode(',', $accept) as $range) {
+            $params = array_map('trim', explode(';', $range));
+            $type = strtolower(array_shift($params));
+            $quality = 1;
+            foreach ($params as $param) {
+                if (strncasecmp($param, 'q=', 2) === 0) {
+                    $quality = floatval(substr($param, 2));
+                }
+            }
+            if ($quality > 0) {
+                array_push($types, $type);
+            }
+        }
+        return $types;
+    }
+
+    private static function servePackedThumbnail($metaId)
+    {
+        // a compaction may remove the pack between reading the index and opening the pack
+        for ($attempt = 0; $attempt < 2; $attempt++) {
+            $entry = self::findPackedThumbnail($metaId);
+            if ($entry === null) {
+                serveError(404);
+            }
+            $pack = @fopen(self::WAG_DIR . '/thumbnails.' . $entry['generation'] . '.pack', 'rb');
+            if ($pack !== false) {
+                fseek($pack, $entry['offset']);
+                $thumbnail = fread($pack, $entry['length']);
+                fclose($pack);
+                self::serveResponse($thumbnail, self::MEDIA_EXT['jpg']);
+                return;
+            }
+        }
+        serveError(404);
+    }
+
+    private static function findPackedThumbnail($metaId)
+    {
+        // the index records are sorted by the binary metadata id
+        $index = @fopen(self::WAG_DIR . '/' . self::PACK_INDEX_FILE, 'rb');
+        if ($index === false) {
+            return null;
+        }
+        $header = unpack('a4magic/Vversion/Vgeneration/Vcount', fread($index, self::PACK_HEADER_SIZE));
+        if ($header['magic'] !== self::PACK_MAGIC || $header['version'] !== self::PACK_VERSION) {
+            fclose($index);
+            return null;
+        }
+        $key = hex2bin($metaId);
+        $low = 0;
+        $high = $header['count'] - 1;
+        while ($low <= $high) {
+            $middle = ($low + $high) >> 1;
+            fseek($index, self::PACK_HEADER_SIZE + $middle * self::PACK_RECORD_SIZE);
+            $record = fread($index, self::PACK_RECORD_SIZE);
+            $cmp = strcmp(substr($record, 0, 16), $key);
+            if ($cmp === 0) {
+                fclose($index);
+                $entry = unpack('Poffset/Vlength', substr($record, 16));
+                $entry['generation'] = $header['generation'];
+                return $entry;
+            } elseif ($cmp < 0) {
+                $low = $middle + 1;
+            } else {
+                $high = $middle - 1;
+            }
+        }
+        fclose($index);
+        return null;
+    }
+
     private function serveHTML()
     {
         header('Content-Type: text/html');
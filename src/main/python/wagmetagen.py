@@ -1,14 +1,30 @@
 import argparse
 import base64
 import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import filecmp
 import hashlib
+import hmac
+import http.client
 import importlib
+import io
 import json
 import logging
 import math
 import numbers
 import os
+import resource
+import shutil
+import string
+import struct
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
 from datetime import datetime
 
 import cv2
@@ -16,23 +32,108 @@ import dateutil.parser
 import imageio
 import iptcinfo3
 import numpy
+from PIL import ExifTags
 from PIL import Image as PILImage
+from PIL import features as PILFeatures
 
 logging.getLogger('iptcinfo').disabled = True
 PILImage.MAX_IMAGE_PIXELS = 10000 * 10000
 
 canReadVideos = importlib.util.find_spec('imageio_ffmpeg') is not None
-
+if canReadVideos:
+    import imageio_ffmpeg
+canWatch = importlib.util.find_spec('inotify_simple') is not None
+if canWatch:
+    import inotify_simple
+canWriteAvif = importlib.util.find_spec('pillow_avif') is not None
+if canWriteAvif:
+    # registers the AVIF plugin of Pillow
+    importlib.import_module('pillow_avif')
+canWriteWebp = PILFeatures.check('webp')
+
+GENERATOR_VERSION = 1
 WAG_DIR = '.wag'
+MANIFEST_FILE = 'manifest.json'
+STORE_DIR = 'store'
+PACK_INDEX_FILE = 'thumbnails.idx'
+PACK_FILE = 'thumbnails.{}.pack'
+TRASH_PREFIX = 'trash-'
+TMP_SUFFIX = '.tmp'
+UPLOAD_RECORD_FILE = 'uploads.{}.log'
+UPLOAD_JOBS = 8
+UPLOAD_RETRIES = 4
+UPLOAD_RETRY_DELAY = 0.5
+UPLOAD_TIMEOUT = 60
+UPLOAD_TYPES = {
+    '.json': 'application/json',
+    '.jpg': 'image/jpeg',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+}
 METADATA_FILE = 'meta.json'
+LISTING_FILE = 'listing.json'
+PASSWORD_FILE = 'password.txt'
 THUMBNAIL_FILE = 'tn.jpg'
 THUMBNAIL_SIZE = 125
+PREVIEW_FILE = 'preview-{}.jpg'
+SPRITE_FILE = 'sprite-{}.jpg'
+# the files written in every configured format, numbered ones with their numbers in place of {}
+DERIVATIVE_FILES = [THUMBNAIL_FILE, PREVIEW_FILE, SPRITE_FILE]
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+FORMAT_JPEG = 'jpeg'
+FORMAT_WEBP = 'webp'
+FORMAT_AVIF = 'avif'
+# the thumbnails and previews are always written as JPEG, and also in the other formats chosen
+FORMAT_EXT = {
+    FORMAT_JPEG: '.jpg',
+    FORMAT_WEBP: '.webp',
+    FORMAT_AVIF: '.avif',
+}
+FORMAT_TYPES = {
+    FORMAT_JPEG: 'image/jpeg',
+    FORMAT_WEBP: 'image/webp',
+    FORMAT_AVIF: 'image/avif',
+}
+FORMAT_PIL = {
+    FORMAT_JPEG: 'JPEG',
+    FORMAT_WEBP: 'WEBP',
+    FORMAT_AVIF: 'AVIF',
+}
+JPEG_SUBSAMPLING = {
+    '4:4:4': 0,
+    '4:2:2': 1,
+    '4:2:0': 2,
+}
+BACKEND_DEFAULT = 'default'
+BACKEND_OPENCV = 'opencv'
+BACKEND_PILLOW = 'pillow'
 PINKYNAIL_SIZE = 50
 PINKYNAIL_SPACING = 7
+WHITE = [255, 255, 255]
+IMAGE_CACHE_SIZE = 0
+WATCH_DELAY = 0.5
+WATCH_MAX_DELAY = 5
+WATCH_POLL = 1
+VIDEO_FRAME_OFFSET = 2
+VIDEO_PROBE_FIELDS = ['size', 'duration', 'fps', 'codec']
 ALBUM = 'album'
 IMAGE = 'image'
 VIDEO = 'video'
+PATH = 'path'
+STAT = 'stat'
+STATS = 'stats'
+LATEST_DATE = 'latestDate'
+LISTING = 'listing'
+STAT_TIME = 'statTime'
 IMAGE_EXT = {'.jpg', '.png', '.jpeg', '.gif'}
+EXIF_FORMATS = {'JPEG', 'MPO'}
+# JPEG images can be decoded at 1/2, 1/4 or 1/8 of their size for a fraction of the cost
+DRAFT_FORMATS = {'JPEG', 'MPO'}
+DRAFT_MODES = {'RGB', 'L'}
+EXIF_ORIENTATION = 0x0112
+# EXIF orientations for which the decoded image is rotated by 90 degrees
+EXIF_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
 VIDEO_EXT = {'.mp4', '.mpeg4', '.m4v', '.webm'}
 SUBALBUM_PINKYNAIL = imageio.imread(base64.b64decode("""
 R0lGODdhMgAyAKEAAAAAAAABAOXl5f///ywAAAAAMgAyAAACzoyPqcsdA8eLtNqL8wASTg2GGfcY
@@ -54,58 +155,603 @@ META_SHUTTER = 'shutter'
 META_APERTURE = 'aperture'
 META_ISO = 'iso'
 META_ZOOM = 'zoom'
+META_PREVIEWS = 'previews'
+META_FILE = 'file'
+META_FORMATS = 'formats'
+META_SPRITE = 'sprite'
+META_X = 'x'
+META_Y = 'y'
+LISTING_ENTRIES = 'entries'
+LISTING_MTIME = 'mtimeNs'
+LISTING_TYPE = 'type'
+LISTING_PATH = 'path'
+LISTING_ALBUM = 'album'
+LISTING_MEDIUM = 'medium'
+MANIFEST_VERSION = 'version'
+MANIFEST_CONFIG = 'config'
+MANIFEST_ENTRIES = 'entries'
+MANIFEST_DATES = 'dates'
+PACK_GENERATION = 'generation'
+PACK_ENTRIES = 'entries'
+PACK_MAGIC = b'WAGP'
+PACK_VERSION = 1
+# the index is sorted by the binary metadata id, so that it can be searched without reading it whole
+PACK_HEADER = struct.Struct('<4sIII')
+PACK_RECORD = struct.Struct('<16sQI')
+PACK_COMPACT_RATIO = 0.5
+STAGE_SCAN = 'scan'
+STAGE_HASH = 'hash'
+STAGE_READ = 'read'
+STAGE_DECODE = 'decode'
+STAGE_VIDEO = 'ffmpeg'
+STAGE_EXIF = 'exif'
+STAGE_IPTC = 'iptc'
+STAGE_RESIZE = 'resize'
+STAGE_ALBUM = 'album'
+STAGE_ENCODE = 'encode'
+STAGE_WRITE = 'write'
+STAGE_FIELDS = ['calls', 'wall', 'cpu', 'bytesRead', 'bytesWritten']
+STAGE_SLOWEST = 'slowest'
+SLOWEST_FILES = 10
+MEMORY_TOP = 10
+# measured peaks of decoding an image with imageio and making its thumbnail are 10-16 bytes per pixel,
+# images decoded in tiles keep only the pixels of Pillow, which are 1 or 4 bytes
+DECODE_BYTES_PER_PIXEL = 16
+PALETTE_MODES = {'1', 'L', 'P'}
+REDUCE_MODES = {'L', 'RGB', 'RGBA'}
+TILE_PIXELS = 4 * 1024 * 1024
+# the previews are kept as 8-bit RGB until they are written
+PREVIEW_BYTES_PER_PIXEL = 3
+# a 4K frame, with its copy, as the video size is not known before running ffmpeg
+VIDEO_FOOTPRINT = 3840 * 2160 * 3 * 2
+NO_STAGE = contextlib.nullcontext()
+
+# the task run by the current thread, see runTask
+currentTask = threading.local()
+# the generator of a worker process, see initWorker
+workerGenerator = None
+
+
+def isimage(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXT
+
+
+def isvideo(name):
+    return os.path.splitext(name)[1].lower() in VIDEO_EXT
+
+
+def estimateFootprint(image, size, itemMemoryBudget):
+    # the peak memory of decoding an opened image and making its thumbnail, from its header only,
+    # and whether it is over the budget of an item and is decoded in tiles
+    if image.format in DRAFT_FORMATS and image.mode in DRAFT_MODES:
+        image.draft(image.mode, (size, size))
+    width, height = image.size
+    footprint = width * height * DECODE_BYTES_PER_PIXEL
+    if itemMemoryBudget is None or footprint <= itemMemoryBudget or \
+            (image.format in DRAFT_FORMATS and image.mode in DRAFT_MODES):
+        return footprint, False
+    pixelBytes = 1 if image.mode in PALETTE_MODES else 4
+    return width * height * pixelBytes + TILE_PIXELS * DECODE_BYTES_PER_PIXEL, True
+
+
+def estimateItemFootprint(image, previewSizes, itemMemoryBudget):
+    # with previews, the image is decoded at the largest preview size and all previews are kept
+    if not isStillOpaqueImage(image):
+        previewSizes = ()
+    width, height = image.size
+    sizes = [size for size in previewSizes if size < max(width, height)]
+    footprint = estimateFootprint(image, max(sizes, default=THUMBNAIL_SIZE), itemMemoryBudget)[0]
+    for size in sizes:
+        scale = size / max(width, height)
+        footprint += max(round(width * scale), 1) * max(round(height * scale), 1) * PREVIEW_BYTES_PER_PIXEL
+    return footprint
+
+
+def runTask(generator, task, *args):
+    # runs a task and returns its result together with its cache statistics
+    # and the metadata it extracted, so they can be passed back from worker processes;
+    # worker processes run their tasks with their own generator
+    previousContext = getattr(currentTask, 'task', None)
+    context = Task(generator if generator is not None else workerGenerator)
+    currentTask.task = context
+    try:
+        result = task(*args)
+        if generator is None:
+            # the files of the task are done before its result is passed back
+            context.counters.update(context.generator.sink.flush())
+    finally:
+        currentTask.task = previousContext
+    return result, context.counters, context.extractedMeta
+
+
+def getTask():
+    task = getattr(currentTask, 'task', None)
+    if task is None:
+        task = Task(defaultGenerator)
+        currentTask.task = task
+    return task
+
+
+def initWorker(config, packs):
+    global workerGenerator
+
+    workerGenerator = MetaGenerator(**config)
+    workerGenerator.packs = packs
+
+
+def runPackedTask(packs, task, *args):
+    # workers kept across runs are given the packs as they are now
+    workerGenerator.packs = packs
+    return runTask(None, task, *args)
+
+
+def runSeededTask(meta, task, *args):
+    # workers are given the metadata already extracted for the items of the task
+    workerGenerator.metaCache.update(meta)
+    return runTask(None, task, *args)
+
+
+def trimToAlbumThumbnailItems(items):
+    # the album thumbnail does not depend on the contents of subalbums
+    return {
+        PATH: items[PATH],
+        STAT: items[STAT],
+        STATS: items[STATS],
+        ALBUM: list(map(lambda x: {PATH: x[PATH]}, items[ALBUM])),
+        IMAGE: items[IMAGE],
+        VIDEO: items[VIDEO],
+    }
 
-processingBase = None
-totalItems = 0
-thumbnailsGenerated = 0
 
+def collectSignatures(items, base, hashContents, previousEntries=None, changed=None):
+    # only the changed albums are signed again when they are known,
+    # the signatures of the other albums and their items are taken from the previous run
+    manifest = {}
+    collectAlbumSignature(items, base, hashContents,
+                          manifest, previousEntries, changed)
+    return manifest
 
-def isimage(path):
-    return os.path.isfile(path) and os.path.splitext(path)[1].lower() in IMAGE_EXT
 
+def collectAlbumSignature(items, base, hashContents, manifest, previousEntries=None, changed=None):
+    # an album depends on its whole subtree (e.g., the latest date of subalbums),
+    # so its signature is derived from the signatures of all its items
+    if changed is not None and items[PATH] not in changed:
+        signature = copyAlbumSignature(items, base, previousEntries, manifest)
+        if signature is not None:
+            return signature
+    itemSignatures = []
+    for album in items[ALBUM]:
+        itemSignatures.append([os.path.basename(album[PATH]),
+                               collectAlbumSignature(album, base, hashContents, manifest, previousEntries, changed)])
+    for path, stat in items[STATS].items():
+        itemSignatures.append([os.path.basename(path),
+                               collectSignature(path, stat, base, hashContents, manifest)])
+    stat = items[STAT]
+    digest = hashlib.md5(json.dumps(
+        sorted(itemSignatures)).encode('utf-8')).hexdigest()
+    signature = [stat.st_mtime_ns, stat.st_ino, digest]
+    manifest[getManifestKey(items[PATH], base)] = signature
+    return signature
+
+
+def copyAlbumSignature(items, base, previousEntries, manifest):
+    for album in items[ALBUM]:
+        if copyAlbumSignature(album, base, previousEntries, manifest) is None:
+            return None
+    for key in [getManifestKey(path, base) for path in items[STATS]] + [getManifestKey(items[PATH], base)]:
+        if key not in previousEntries:
+            return None
+        manifest[key] = previousEntries[key]
+    return manifest[getManifestKey(items[PATH], base)]
+
+
+def collectSignature(path, stat, base, hashContents, manifest):
+    signature = [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+    if hashContents:
+        signature.append(getContentHash(path, stat))
+    manifest[getManifestKey(path, base)] = signature
+    return signature
+
+
+def getContentHash(path, stat):
+    # the same hash signs the item and keys its thumbnails in the store
+    return getCachedMeta(getCacheKey(path, stat) + ('hash',), lambda: hashFile(path))
+
+
+def hashFile(path):
+    digest = hashlib.md5()
+    with measureStage(STAGE_HASH, path):
+        if path in getTask().sources:
+            digest.update(readSource(path))
+            return digest.hexdigest()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                getTask().counters['bytesRead'] += len(chunk)
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def sharedSource(path):
+    # while an item is processed, its source is read at most once, by the first of the decoder,
+    # the EXIF and IPTC parsers and the hash which needs it, and the others parse it from memory
+    sources = getTask().sources
+    sources[path] = None
+    try:
+        yield
+    finally:
+        del sources[path]
+
+
+def readSource(path):
+    sources = getTask().sources
+    data = sources.get(path, None)
+    if data is None:
+        with measureStage(STAGE_READ, path), open(path, 'rb') as f:
+            data = f.read()
+            getTask().counters['bytesRead'] += len(data)
+        if path in sources:
+            sources[path] = data
+    return data
+
+
+class SourceReader(io.RawIOBase):
+    # a source file read on demand, counting the bytes actually read
+
+    def __init__(self, path):
+        self.file = open(path, 'rb', buffering=0)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.file.readinto(buffer)
+        getTask().counters['bytesRead'] += count or 0
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+@contextlib.contextmanager
+def openSource(path):
+    # the parsers read from the shared source of an item being processed, and otherwise
+    # only the parts of the file they need, e.g. the headers of unchanged items of an album
+    if path in getTask().sources:
+        yield io.BytesIO(readSource(path))
+        return
+    with io.BufferedReader(SourceReader(path)) as f:
+        yield f
 
-def isvideo(path):
-    return os.path.isfile(path) and os.path.splitext(path)[1].lower() in VIDEO_EXT
 
+def getManifestKey(path, base):
+    relPath = os.path.relpath(path, base)
+    if relPath == '.':
+        relPath = ''
+    return relPath
 
-def process(path):
-    global totalItems
 
-    totalItems += 1
-    processAlbum(path)
+def getManifestConfig(hashContents):
+    config = {
+        'generator': GENERATOR_VERSION,
+        'thumbnailSize': THUMBNAIL_SIZE,
+        'pinkynailSize': PINKYNAIL_SIZE,
+        'canReadVideos': canReadVideos,
+        'hashContents': hashContents,
+    }
+    # only when enabled, so that the manifests of earlier runs stay valid
+    previewSizes = getTask().generator.previewSizes
+    if previewSizes:
+        config['previewSizes'] = previewSizes
+    encoderConfig = getTask().generator.encoderConfig
+    if encoderConfig:
+        config['encoder'] = encoderConfig
+    if getTask().generator.sprites:
+        config['sprites'] = True
+    # images over the budget of an item are decoded in tiles, which changes their thumbnails
+    itemMemoryBudget = getTask().generator.itemMemoryBudget
+    if itemMemoryBudget is not None:
+        config['itemMemoryBudget'] = itemMemoryBudget
+    backend = getTask().generator.config['backend']
+    if backend != BACKEND_DEFAULT:
+        config['backend'] = backend
+    return config
+
+
+def makeManifest(entries=None):
+    return {
+        MANIFEST_ENTRIES: entries if entries is not None else {},
+        MANIFEST_DATES: {},
+    }
 
-    items = getItems(path)
-    totalItems += len(items[IMAGE])
-    totalItems += sum(map(lambda x: len(x[VIDEO]), items[VIDEO]))
-    totalItems += len(list(
-        filter(lambda x: x[IMAGE] is not None, items[VIDEO])
-    ))
 
-    for image in items[IMAGE]:
-        processImage(image)
-    for video in items[VIDEO]:
-        processVideo(video)
-    for subfolder in items[ALBUM]:
-        process(subfolder)
+def readManifest(base, hashContents):
+    try:
+        with open(os.path.join(base, WAG_DIR, MANIFEST_FILE), encoding='utf-8') as manifestFile:
+            manifest = json.load(manifestFile)
+    except (OSError, ValueError):
+        return makeManifest()
+    if manifest.get(MANIFEST_VERSION, None) != GENERATOR_VERSION or manifest.get(MANIFEST_CONFIG, None) != getManifestConfig(hashContents):
+        return makeManifest()
+    previousManifest = makeManifest(manifest.get(MANIFEST_ENTRIES, {}))
+    previousManifest[MANIFEST_DATES] = manifest.get(MANIFEST_DATES, {})
+    return previousManifest
 
 
-def getItems(path):
-    items = {ALBUM: [], IMAGE: [], VIDEO: []}
+def writeManifest(base, hashContents, currentManifest):
+    dst = os.path.join(base, WAG_DIR)
+    if not os.path.exists(dst):
+        os.makedirs(dst)
+    manifest = {
+        MANIFEST_VERSION: GENERATOR_VERSION,
+        MANIFEST_CONFIG: getManifestConfig(hashContents),
+        MANIFEST_ENTRIES: currentManifest[MANIFEST_ENTRIES],
+        MANIFEST_DATES: currentManifest[MANIFEST_DATES],
+    }
+    writeFile(os.path.join(dst, MANIFEST_FILE), json.dumps(
+        manifest, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+
+
+def readPack(base):
+    # thumbnails are appended to a pack file and found through an index, the generation
+    # changes when the pack is compacted so that readers of the previous index can finish
+    pack = {PACK_GENERATION: 0, PACK_ENTRIES: {}}
+    try:
+        with open(os.path.join(base, WAG_DIR, PACK_INDEX_FILE), 'rb') as indexFile:
+            index = indexFile.read()
+    except OSError:
+        return pack
+    magic, version, generation, count = PACK_HEADER.unpack_from(index)
+    if magic != PACK_MAGIC or version != PACK_VERSION:
+        return pack
+    pack[PACK_GENERATION] = generation
+    for i in range(count):
+        metaId, offset, length = PACK_RECORD.unpack_from(
+            index, PACK_HEADER.size + i * PACK_RECORD.size)
+        pack[PACK_ENTRIES][metaId.hex()] = (offset, length)
+    return pack
+
+
+def writePackIndex(base, pack):
+    index = [PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION,
+                              pack[PACK_GENERATION], len(pack[PACK_ENTRIES]))]
+    for metaId, (offset, length) in sorted(pack[PACK_ENTRIES].items()):
+        index.append(PACK_RECORD.pack(bytes.fromhex(metaId), offset, length))
+    writeFile(os.path.join(base, WAG_DIR, PACK_INDEX_FILE), b''.join(index))
+
+
+def getPackPath(base, generation):
+    return os.path.join(base, WAG_DIR, PACK_FILE.format(generation))
+
+
+def packThumbnails(base, pack, previousManifest, currentManifest, compact=False):
+    # the thumbnails written by the run are moved to the pack, entries of removed items are dropped
+    # and the pack is rewritten once most of it is taken by replaced thumbnails
+    entries = {}
+    appended = []
+    for key, signature in currentManifest[MANIFEST_ENTRIES].items():
+        metaId = hashlib.md5(key.encode('utf-8')).hexdigest()
+        if metaId in pack[PACK_ENTRIES]:
+            entries[metaId] = pack[PACK_ENTRIES][metaId]
+        if metaId not in entries or previousManifest[MANIFEST_ENTRIES].get(key, None) != signature:
+            tnPath = os.path.join(base, WAG_DIR, metaId, THUMBNAIL_FILE)
+            if os.path.isfile(tnPath):
+                appended.append((metaId, tnPath))
+    with open(getPackPath(base, pack[PACK_GENERATION]), 'a+b') as packFile:
+        offset = packFile.tell()
+        for metaId, tnPath in appended:
+            with open(tnPath, 'rb') as tnFile:
+                data = tnFile.read()
+            # regenerated thumbnails which did not change are not appended again
+            if metaId in entries and entries[metaId][1] == len(data):
+                packFile.seek(entries[metaId][0])
+                if packFile.read(len(data)) == data:
+                    continue
+            packFile.write(data)
+            entries[metaId] = (offset, len(data))
+            offset += len(data)
+    pack[PACK_ENTRIES] = entries
+    live = sum(length for _, length in entries.values())
+    if compact or offset - live > offset * PACK_COMPACT_RATIO:
+        compactPack(base, pack)
+    else:
+        writePackIndex(base, pack)
+    # the index is written before the thumbnail files are removed, so they can always be found
+    for _, tnPath in appended:
+        os.remove(tnPath)
+
+
+def compactPack(base, pack):
+    previousPath = getPackPath(base, pack[PACK_GENERATION])
+    generation = pack[PACK_GENERATION] + 1
+    entries = {}
+    with open(previousPath, 'rb') as previousFile, open(getPackPath(base, generation), 'wb') as packFile:
+        for metaId, (offset, length) in sorted(pack[PACK_ENTRIES].items(), key=lambda entry: entry[1][0]):
+            previousFile.seek(offset)
+            entries[metaId] = (packFile.tell(), length)
+            packFile.write(previousFile.read(length))
+    pack[PACK_GENERATION] = generation
+    pack[PACK_ENTRIES] = entries
+    writePackIndex(base, pack)
+    # readers of the previous index may still open the previous pack, it is removed
+    # by the next compaction or by --gc; the one before it had a whole run for its readers
+    removePacks(base, {generation - 1, generation})
+
+
+def removePacks(base, generations, dryRun=False):
+    # the packs of other generations than the given ones
+    counters = collections.Counter()
+    prefix, suffix = PACK_FILE.split('{}')
+    with os.scandir(os.path.join(base, WAG_DIR)) as entries:
+        for entry in entries:
+            generation = entry.name[len(prefix):-len(suffix)]
+            if not entry.name.startswith(prefix) or not entry.name.endswith(suffix) or not generation.isdigit() or \
+                    int(generation) in generations or not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            if dryRun:
+                print(os.path.join(WAG_DIR, entry.name))
+            else:
+                os.remove(entry.path)
+            counters['packs'] += 1
+            counters['orphanBytes'] += stat.st_size
+    return counters
+
+
+def collectGarbage(base, currentManifest, start, dryRun=False, store=None):
+    # entries of items which are no longer in the tree are moved away at once and then removed,
+    # so the web server never sees a partially removed entry; entries changed since the start
+    # of the run are left alone, as they may have been written by another run;
+    # only the bytes of files with no other links are freed, stored thumbnails linked
+    # by nothing but the orphans are removed with them; temporary files left by interrupted runs go too
+    counters = collections.Counter()
+    liveIds = {hashlib.md5(key.encode('utf-8')).hexdigest()
+               for key in currentManifest[MANIFEST_ENTRIES]}
+    orphans = []
+    wagDir = os.path.join(base, WAG_DIR)
+    with os.scandir(wagDir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and entry.name.startswith(TRASH_PREFIX) and entry.stat().st_mtime < start:
+                # left by an interrupted collection
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.is_dir(follow_symlinks=False) and isMetaId(entry.name) and entry.name not in liveIds and entry.stat().st_mtime < start:
+                orphans.append(entry)
+            elif entry.is_dir(follow_symlinks=False) and isMetaId(entry.name):
+                with os.scandir(entry.path) as files:
+                    for f in files:
+                        collectTempFile(f, base, start, dryRun, counters)
+            else:
+                collectTempFile(entry, base, start, dryRun, counters)
+    indexPath = os.path.join(wagDir, PACK_INDEX_FILE)
+    if os.path.isfile(indexPath):
+        # the previous pack is kept while the index replacing it is newer than the run
+        generation = readPack(base)[PACK_GENERATION]
+        generations = {generation}
+        if os.stat(indexPath).st_mtime >= start:
+            generations.add(generation - 1)
+        counters.update(removePacks(base, generations, dryRun))
+    if not orphans:
+        return counters
+    trash = None if dryRun else tempfile.mkdtemp(
+        prefix=TRASH_PREFIX, dir=wagDir)
+    # the links, the size and the number of orphaned links of every file
+    links = {}
+    for entry in orphans:
+        with os.scandir(entry.path) as files:
+            for f in files:
+                stat = f.stat(follow_symlinks=False)
+                links.setdefault(stat.st_ino, [stat.st_nlink, stat.st_size, 0])[2] += 1
+        if dryRun:
+            print(os.path.join(WAG_DIR, entry.name))
+        else:
+            os.rename(entry.path, os.path.join(trash, entry.name))
+        counters['orphans'] += 1
+    stored = {ino for ino, (nlink, _, count) in links.items() if nlink == count + 1}
+    if store is not None and stored and os.path.isdir(store):
+        for path, stat in scanStore(store):
+            if stat.st_ino in stored and stat.st_nlink == links[stat.st_ino][2] + 1:
+                if dryRun:
+                    print(path)
+                else:
+                    os.remove(path)
+                links[stat.st_ino][2] += 1
+                counters['storeOrphans'] += 1
+    counters['orphanBytes'] += sum(size for nlink, size, count in links.values() if nlink == count)
+    if trash is not None:
+        shutil.rmtree(trash)
+    return counters
+
+
+def collectTempFile(entry, base, start, dryRun, counters):
+    if not entry.name.endswith(TMP_SUFFIX) or not entry.is_file(follow_symlinks=False) or \
+            entry.stat(follow_symlinks=False).st_mtime >= start:
+        return
+    if dryRun:
+        print(os.path.relpath(entry.path, base))
+    else:
+        os.remove(entry.path)
+    counters['tmpFiles'] += 1
+
+
+def scanStore(store):
+    with os.scandir(store) as folders:
+        for folder in folders:
+            if folder.is_dir(follow_symlinks=False):
+                with os.scandir(folder.path) as files:
+                    for f in files:
+                        if f.is_file(follow_symlinks=False):
+                            yield f.path, f.stat(follow_symlinks=False)
+
+
+def isMetaId(name):
+    return len(name) == 32 and all(c in string.hexdigits for c in name)
+
+
+def hasThumbnail(path, base):
+    pack = getTask().generator.packs.get(base, None)
+    if pack is not None and getMetaId(path, base) in pack[PACK_ENTRIES]:
+        return True
+    return os.path.isfile(os.path.join(getMetaDir(path, base), THUMBNAIL_FILE))
+
+
+def readThumbnail(path, base):
+    # thumbnails generated by the current run are not packed yet
+    tnPath = os.path.join(getMetaDir(path, base), THUMBNAIL_FILE)
+    pack = getTask().generator.packs.get(base, None)
+    if pack is None or os.path.isfile(tnPath):
+        with open(tnPath, 'rb') as tnFile:
+            return tnFile.read()
+    offset, length = pack[PACK_ENTRIES][getMetaId(path, base)]
+    with open(getPackPath(base, pack[PACK_GENERATION]), 'rb') as packFile:
+        packFile.seek(offset)
+        return packFile.read(length)
+
+
+def scanAlbum(path, stat=None, statTime=None):
+    # the whole tree is scanned once and every stage works with the scanned items;
+    # the stats of the album and its media are kept to avoid touching the file system again,
+    # with the time before the album was stat'ed
+    if stat is None:
+        statTime = time.time()
+        stat = os.stat(path)
+    items = {PATH: path, STAT: stat, STAT_TIME: statTime,
+             STATS: {}, ALBUM: [], IMAGE: [], VIDEO: [], LISTING: []}
 
-    entries = map(lambda x: os.path.join(path, x), filter(
-        lambda x: x != WAG_DIR, os.listdir(path)))
     groups = {}
-    for entry in entries:
-        key = os.path.splitext(os.path.basename(entry))[0]
-        group = groups.get(
-            key, {ALBUM: [], IMAGE: [], VIDEO: []})
-        if isimage(entry):
-            group[IMAGE].append(entry)
-        elif isvideo(entry):
-            group[VIDEO].append(entry)
-        elif os.path.isdir(entry):
-            group[ALBUM].append(entry)
-        groups[key] = group
+    with measureStage(STAGE_SCAN, path), os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name == WAG_DIR:
+                continue
+            key = os.path.splitext(entry.name)[0]
+            group = groups.get(
+                key, {ALBUM: [], IMAGE: [], VIDEO: []})
+            if entry.is_file() and isimage(entry.name):
+                group[IMAGE].append(entry.path)
+                items[STATS][entry.path] = entry.stat()
+                items[LISTING].append((entry.name, LISTING_MEDIUM))
+            elif entry.is_file() and isvideo(entry.name):
+                group[VIDEO].append(entry.path)
+                items[STATS][entry.path] = entry.stat()
+                items[LISTING].append((entry.name, LISTING_MEDIUM))
+            elif entry.is_dir():
+                # protected albums are listed too, wag.php leaves them out when it serves the listing
+                statTime = time.time()
+                album = scanAlbum(entry.path, entry.stat(), statTime)
+                group[ALBUM].append(album)
+                items[LISTING].append((entry.name, LISTING_ALBUM))
+            groups[key] = group
+    # in the order of the listing of wag.php
+    items[LISTING].sort()
     for group in groups.values():
         for album in group[ALBUM]:
             items[ALBUM].append(album)
@@ -123,107 +769,507 @@ def getItems(path):
     return items
 
 
-def processAlbum(path):
-    global thumbnailsGenerated
-
-    items = getItems(path)
+def outputListing(items, base):
+    # the entries of the album as listed by wag.php, which serves this file instead while the
+    # modification time of the folder is the one from before the scan; wag.php sees that time in
+    # seconds only, so it is left out when a later change within the same second could go unnoticed
+    dst = makeMetaDir(items[PATH], base)
+    key = getManifestKey(items[PATH], base)
+    stat = items[STAT]
+    listing = {
+        LISTING_ENTRIES: [{LISTING_TYPE: entryType, LISTING_PATH: key + '/' + name if key else name}
+                          for name, entryType in items[LISTING]],
+        LISTING_MTIME: stat.st_mtime_ns if math.floor(stat.st_mtime) < math.floor(items[STAT_TIME]) else None,
+    }
+    writeFile(os.path.join(dst, LISTING_FILE), json.dumps(
+        listing, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+
+
+def processAlbum(items, meta, base):
+    with measureStage(STAGE_ALBUM, items[PATH]):
+        tn = makeAlbumThumbnail(items, base)
+    outputThumbnail(tn, items[PATH], base)
+    fileNames = getFormatFiles(THUMBNAIL_FILE)
+    if getTask().generator.sprites:
+        meta = dict(meta)
+        with measureStage(STAGE_ALBUM, items[PATH]):
+            sheets, sprites = makeSprites(items, base)
+        for index, sheet in enumerate(sheets):
+            outputThumbnail(sheet, items[PATH], base,
+                            SPRITE_FILE.format(index))
+            fileNames += getFormatFiles(SPRITE_FILE.format(index))
+        for itemId, (index, x, y) in sprites.items():
+            meta[META_ITEMS][itemId][META_SPRITE] = {
+                META_FILE: SPRITE_FILE.format(index),
+                META_X: x,
+                META_Y: y,
+            }
+    # also the sheets of runs with sprites, or with more items
+    removeOtherDerivatives(getMetaDir(items[PATH], base), fileNames)
+    outputMeta(meta, items[PATH], base)
+    return 1
+
+
+def makeSprites(items, base):
+    # the thumbnails of the album items are tiled into sheets, so that an album page needs
+    # a request per sheet instead of per item; items sharing a thumbnail share the tile
+    paths = [album[PATH] for album in items[ALBUM]] + sorted(items[IMAGE])
+    for video in sorted(items[VIDEO], key=lambda video: sorted(video[VIDEO])[0]):
+        paths += sorted(video[VIDEO])
+    tiles = collections.OrderedDict()
+    positions = {}
+    for path in paths:
+        if hasThumbnail(path, base):
+            tile = tiles.setdefault(readThumbnail(path, base), len(tiles))
+            positions[getMetaId(path, base)] = getSpritePosition(tile)
+    sheets = []
+    for tile, data in enumerate(tiles):
+        index, x, y = getSpritePosition(tile)
+        if index == len(sheets):
+            count = min(len(tiles) - tile, SPRITE_COLUMNS * SPRITE_ROWS)
+            sheets.append(255 * numpy.ones((math.ceil(count / SPRITE_COLUMNS) * THUMBNAIL_SIZE,
+                                            min(count, SPRITE_COLUMNS) * THUMBNAIL_SIZE, 3), numpy.uint8))
+        sheets[index][y:(y + THUMBNAIL_SIZE), x:(x + THUMBNAIL_SIZE)] = \
+            imageio.imread(data, format='jpg')[0:THUMBNAIL_SIZE, 0:THUMBNAIL_SIZE, 0:3]
+    return sheets, positions
+
+
+def getSpritePosition(tile):
+    index, cell = divmod(tile, SPRITE_COLUMNS * SPRITE_ROWS)
+    return index, (cell % SPRITE_COLUMNS) * THUMBNAIL_SIZE, (cell // SPRITE_COLUMNS) * THUMBNAIL_SIZE
+
+
+def makeAlbumThumbnail(items, base):
     pinkyNails = []
     if len(items[ALBUM]) > 0:
-        pinkyNails.append(makeThumbnail(SUBALBUM_PINKYNAIL, PINKYNAIL_SIZE))
+        pinkyNails.append(getTask().generator.backend.thumbnail(
+            SUBALBUM_PINKYNAIL, PINKYNAIL_SIZE))
+    # the pinkynails are made from the thumbnails of the items, which are generated before the album
     for image in sorted(items[IMAGE]):
         if len(pinkyNails) > 3:
             break
-        pinkyNails.append(makeThumbnail(imageio.imread(image), PINKYNAIL_SIZE))
+        pinkyNails.append(makePinkynail(
+            image, getImageMeta(image, items[STATS][image]), base))
     for video in sorted(items[VIDEO], key=lambda video: sorted(video[VIDEO])[0]):
         if len(pinkyNails) > 3:
             break
         if video[IMAGE]:
-            pinkyNails.append(makeThumbnail(
-                imageio.imread(video[IMAGE]), PINKYNAIL_SIZE))
+            pinkyNails.append(makePinkynail(video[IMAGE], getImageMeta(
+                video[IMAGE], items[STATS][video[IMAGE]]), base))
         elif canReadVideos:
-            pinkyNails.append(makeThumbnail(
-                readFrame(video[VIDEO][0]), PINKYNAIL_SIZE))
+            pinkyNails.append(makePinkynail(video[VIDEO][0], getVideoMeta(
+                video[VIDEO][0], items[STATS][video[VIDEO][0]]), base))
     tn = 255 * numpy.ones((THUMBNAIL_SIZE, THUMBNAIL_SIZE, 3), numpy.uint8)
     for i, pinkynail in enumerate(pinkyNails):
         x = PINKYNAIL_SPACING + (i % 2) * (PINKYNAIL_SIZE + PINKYNAIL_SPACING)
         y = PINKYNAIL_SPACING + int(i / 2) * \
             (PINKYNAIL_SIZE + PINKYNAIL_SPACING)
         tn[y:(y + PINKYNAIL_SIZE), x:(x + PINKYNAIL_SIZE)] = pinkynail
-    outputThumbnail(tn, path)
-    outputMeta(extractAlbumMeta(path), path)
-    thumbnailsGenerated += 1
-
-
-def processImage(path):
-    global processingBase
-    global thumbnailsGenerated
-
-    image = imageio.imread(path)
-    outputThumbnail(makeThumbnail(image, THUMBNAIL_SIZE), path)
-    outputMeta(extractImageMeta(path, image), path)
-    thumbnailsGenerated += 1
-
-
-def processVideo(group):
-    global thumbnailsGenerated
-
+    return tn
+
+
+def makePinkynail(path, meta, base):
+    tn = imageio.imread(readThumbnail(path, base), format='jpg')
+    # the thumbnail holds the centered square of the item, padded when the item is smaller
+    side = min(meta.get(META_WIDTH, THUMBNAIL_SIZE),
+               meta.get(META_HEIGHT, THUMBNAIL_SIZE), THUMBNAIL_SIZE)
+    offset = math.floor((THUMBNAIL_SIZE - side) / 2)
+    return getTask().generator.backend.thumbnail(tn[offset:(offset + side), offset:(offset + side)], PINKYNAIL_SIZE)
+
+
+def processImage(path, stat, base, store=None):
+    with sharedSource(path):
+        return processSharedImage(path, stat, base, store)
+
+
+def processSharedImage(path, stat, base, store):
+    meta = getImageMeta(path, stat)
+    previews = getPreviews(path, meta)
+    fileNames = getFormatFiles(THUMBNAIL_FILE)
+    for preview in previews:
+        fileNames += getFormatFiles(preview[META_FILE])
+    storePaths = [getStorePath(path, stat, store, fileName)
+                  for fileName in fileNames]
+    if not fetchThumbnails(storePaths, fileNames, path, base):
+        if previews:
+            image = readImage(path, stat, max(
+                previews[-1][META_WIDTH], previews[-1][META_HEIGHT]))
+            images, image = makePreviews(image, previews, path)
+            for preview, previewImage in zip(previews, images):
+                outputThumbnail(getTask().generator.backend.flatten(previewImage), path,
+                                base, preview[META_FILE])
+        else:
+            image = readImage(path, stat, THUMBNAIL_SIZE)
+        outputThumbnail(resizeThumbnail(image, path), path, base)
+        storeThumbnails(storePaths, fileNames, path, base)
+    removeOtherDerivatives(getMetaDir(path, base), fileNames)
+    if previews:
+        meta = dict(meta)
+        meta[META_PREVIEWS] = previews
+    outputMeta(meta, path, base)
+    return 1
+
+
+def getPreviews(path, meta):
+    # the preview sizes follow from the image size, so they are known without decoding;
+    # sizes not smaller than the image are served by the image itself
+    previews = []
+    if not getTask().generator.previewSizes or not isStillOpaque(path):
+        return previews
+    width, height = meta.get(META_WIDTH, 0), meta.get(META_HEIGHT, 0)
+    for size in getTask().generator.previewSizes:
+        if size >= max(width, height):
+            break
+        scale = size / max(width, height)
+        previews.append({
+            META_FILE: PREVIEW_FILE.format(size),
+            META_WIDTH: max(round(width * scale), 1),
+            META_HEIGHT: max(round(height * scale), 1),
+        })
+    return previews
+
+
+def isStillOpaque(path):
+    # previews would keep only the first frame of animations and flatten transparent pixels,
+    # so such images are always served as they are
+    with openSource(path) as f, PILImage.open(f) as image:
+        return isStillOpaqueImage(image)
+
+
+def isStillOpaqueImage(image):
+    return not getattr(image, 'is_animated', False) and 'A' not in image.mode and 'transparency' not in image.info
+
+
+def makePreviews(image, previews, path):
+    # every preview is scaled down from the next larger one, and the thumbnail from the smallest
+    # one still covering it, so that the decoded image is scaled down in full only once
+    images = []
+    source = image
+    backend = getTask().generator.backend
+    with measureStage(STAGE_RESIZE, path):
+        for preview in reversed(previews):
+            image = backend.resize(
+                image, preview[META_WIDTH], preview[META_HEIGHT])
+            images.append(image)
+            if min(image.shape[0:2]) >= THUMBNAIL_SIZE:
+                source = image
+    images.reverse()
+    return images, source
+
+
+def processVideo(group, stats, base, store=None):
+    thumbnailsGenerated = 0
     if not group[IMAGE] and not canReadVideos:
         print('Cannot generate thumbnail for videos:',
               group[VIDEO], file=sys.stderr)
-        return
+        return thumbnailsGenerated
     if group[IMAGE]:
-        image = imageio.imread(group[IMAGE])
-        tn = makeThumbnail(image, THUMBNAIL_SIZE)
-        outputThumbnail(tn, group[IMAGE])
-        meta = extractImageMeta(group[IMAGE], image)
-        outputMeta(meta, group[IMAGE])
+        fileNames = getFormatFiles(THUMBNAIL_FILE)
+        with sharedSource(group[IMAGE]):
+            storePaths = [getStorePath(group[IMAGE], stats[group[IMAGE]], store, fileName)
+                          for fileName in fileNames]
+            if not fetchThumbnails(storePaths, fileNames, group[IMAGE], base):
+                image = readImage(
+                    group[IMAGE], stats[group[IMAGE]], THUMBNAIL_SIZE)
+                outputThumbnail(resizeThumbnail(
+                    image, group[IMAGE]), group[IMAGE], base)
+                storeThumbnails(storePaths, fileNames, group[IMAGE], base)
+            removeOtherDerivatives(getMetaDir(group[IMAGE], base), fileNames)
+            meta = getImageMeta(group[IMAGE], stats[group[IMAGE]])
+        outputMeta(meta, group[IMAGE], base)
         thumbnailsGenerated += 1
         for video in group[VIDEO]:
-            outputThumbnail(tn, video)
-            videoMeta = extractVideoMeta(video)
+            for fileName in fileNames:
+                linkFile(os.path.join(getMetaDir(group[IMAGE], base), fileName),
+                         os.path.join(makeMetaDir(video, base), fileName))
+            removeOtherDerivatives(getMetaDir(video, base), fileNames)
+            videoMeta = dict(getVideoMeta(video, stats[video]))
             videoMeta.update(meta)
-            outputMeta(videoMeta, video)
+            outputMeta(videoMeta, video, base)
             thumbnailsGenerated += 1
     else:
         for video in group[VIDEO]:
-            tn = makeThumbnail(readFrame(video), THUMBNAIL_SIZE)
-            outputThumbnail(tn, video)
-            outputMeta(extractVideoMeta(video), video)
+            tn = resizeThumbnail(readVideoFrame(
+                video, stats[video]), video)
+            outputThumbnail(tn, video, base)
+            removeOtherDerivatives(getMetaDir(video, base), getFormatFiles(THUMBNAIL_FILE))
+            outputMeta(getVideoMeta(video, stats[video]), video, base)
             thumbnailsGenerated += 1
+    return thumbnailsGenerated
 
 
-def readFrame(path):
+def getStorePath(path, stat, store, fileName=THUMBNAIL_FILE):
+    # thumbnails are stored by the content of the source and the parameters they were generated with,
+    # so that renamed and moved items do not need to be decoded again
+    if store is None:
+        return None
+    contentHash = getContentHash(path, stat)
+    params = [GENERATOR_VERSION, THUMBNAIL_SIZE, fileName]
+    # the thumbnails are scaled down from the previews
+    previewSizes = getTask().generator.previewSizes
+    if previewSizes:
+        params.append(previewSizes)
+    encoderConfig = getTask().generator.encoderConfig
+    if encoderConfig:
+        params.append(encoderConfig)
+    itemMemoryBudget = getTask().generator.itemMemoryBudget
+    if itemMemoryBudget is not None:
+        params.append(itemMemoryBudget)
+    backend = getTask().generator.config['backend']
+    if backend != BACKEND_DEFAULT:
+        params.append(backend)
+    digest = hashlib.md5(
+        (contentHash + json.dumps(params)).encode('utf-8')).hexdigest()
+    return os.path.join(store, digest[:2], digest + os.path.splitext(fileName)[1])
+
+
+def fetchThumbnail(storePath, path, base, fileName=THUMBNAIL_FILE):
+    if storePath is None:
+        return False
+    if not os.path.isfile(storePath):
+        getTask().counters['storeMisses'] += 1
+        return False
+    getTask().counters['storeHits'] += 1
+    linkFile(storePath, os.path.join(
+        makeMetaDir(path, base), fileName))
+    return True
+
+
+def fetchThumbnails(storePaths, fileNames, path, base):
+    # every file is looked up, so that all of them are counted
+    if not all([fetchThumbnail(storePath, path, base, fileName)
+                for storePath, fileName in zip(storePaths, fileNames)]):
+        return False
+    return True
+
+
+def storeThumbnails(storePaths, fileNames, path, base):
+    for storePath, fileName in zip(storePaths, fileNames):
+        storeThumbnail(storePath, path, base, fileName)
+
+
+def storeThumbnail(storePath, path, base, fileName=THUMBNAIL_FILE):
+    if storePath is None:
+        return
+    os.makedirs(os.path.dirname(storePath), exist_ok=True)
+    try:
+        linkFile(os.path.join(getMetaDir(path, base),
+                              fileName), storePath, False)
+    except FileExistsError:
+        # another worker stored the same content
+        pass
+
+
+def linkFile(src, dst, replace=True):
+    # the output goes to the sink, the store is linked directly
+    if not replace:
+        makeLink(src, dst)
+        return
+    getTask().generator.sink.link(src, dst)
+
+
+def makeLink(src, dst):
+    # hardlinks keep a single copy of the thumbnail, copies are made where the file system does not support them
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def getCacheKey(path, stat):
+    return (path, stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def getCachedImage(key, decode):
+    # the image is decoded outside of the lock, other threads may decode it too meanwhile
+    task = getTask()
+    generator = task.generator
+    if generator.imageCacheSize <= 0:
+        return decode()
+    with generator.lock:
+        image = generator.imageCache.get(key, None)
+        if image is not None:
+            generator.imageCache.move_to_end(key)
+    if image is not None:
+        task.counters['imageHits'] += 1
+        return image
+    task.counters['imageMisses'] += 1
+    image = decode()
+    if image is None:
+        return image
+    with generator.lock:
+        if key not in generator.imageCache:
+            generator.imageCache[key] = image
+            generator.imageCacheBytes += image.nbytes
+        while generator.imageCacheBytes > generator.imageCacheSize and len(generator.imageCache) > 1:
+            _, evicted = generator.imageCache.popitem(last=False)
+            generator.imageCacheBytes -= evicted.nbytes
+    return image
+
+
+def getCachedMeta(key, extract):
+    task = getTask()
+    meta = task.generator.metaCache.get(key, None)
+    if meta is not None:
+        task.counters['metaHits'] += 1
+        return meta
+    task.counters['metaMisses'] += 1
+    meta = extract()
+    task.generator.metaCache[key] = meta
+    task.extractedMeta[key] = meta
+    return meta
+
+
+def readImage(path, stat, size=None):
+    return getCachedImage(getCacheKey(path, stat) + (size,), lambda: getTask().generator.backend.decode(path, size))
+
+
+def decodeImage(path, size=None):
+    # when the image is needed only at a given size, JPEG images are decoded with
+    # the largest reduction which still covers the size in both dimensions
+    # images too large for the memory budget are reduced in tiles instead
+    with measureStage(STAGE_DECODE, path):
+        data = readSource(path)
+        if size is not None:
+            with PILImage.open(io.BytesIO(data)) as image:
+                orientation = None
+                if image.format in EXIF_FORMATS and 'exif' in image.info:
+                    orientation = image._getexif().get(EXIF_ORIENTATION, None)
+                if image.format in DRAFT_FORMATS and image.mode in DRAFT_MODES:
+                    image.draft(image.mode, (size, size))
+                    return rotateImage(numpy.asarray(image), orientation)
+                if estimateFootprint(image, size, getTask().generator.itemMemoryBudget)[1]:
+                    return rotateImage(reduceImage(image, size), orientation)
+        return imageio.imread(data, format=os.path.splitext(path)[1])
+
+
+def reduceImage(image, size):
+    # the image is averaged down to at least the size in both dimensions in horizontal strips,
+    # so that besides the decoded image only a strip is converted at a time; the result
+    # is what imageio would produce, but already reduced
+    mode = image.mode
+    if mode not in REDUCE_MODES:
+        mode = 'RGBA' if 'A' in mode or 'transparency' in image.info else 'RGB'
+    width, height = image.size
+    factor = max(min(width, height) // size, 1)
+    width = width // factor * factor
+    height = height // factor * factor
+    rows = max(TILE_PIXELS // width // factor, 1) * factor
+    strips = []
+    for y in range(0, height, rows):
+        strip = image.crop((0, y, width, min(y + rows, height)))
+        if strip.mode != mode:
+            strip = strip.convert(mode)
+        strips.append(numpy.asarray(strip.reduce(factor)))
+    return numpy.concatenate(strips)
+
+
+def rotateImage(image, orientation):
+    # same as imageio for decoded JPEG images, which rotates and then mirrors the mirrored orientations
+    if orientation in [3, 4]:
+        image = numpy.rot90(image, 2)
+    elif orientation in [5, 6]:
+        image = numpy.rot90(image, 3)
+    elif orientation in [7, 8]:
+        image = numpy.rot90(image)
+    if orientation in [2, 4, 5, 7]:
+        image = numpy.fliplr(image)
+    return image
+
+
+def readVideoFrame(path, stat):
+    return getCachedImage(getCacheKey(path, stat), lambda: readFrame(path, stat))
+
+
+def getVideoProbe(path, stat):
+    return getCachedMeta(getCacheKey(path, stat) + ('probe',), lambda: probeVideo(path))
+
+
+def getImageMeta(path, stat):
+    return getCachedMeta(getCacheKey(path, stat), lambda: extractImageMeta(path, stat))
+
+
+def getVideoMeta(path, stat):
+    return getCachedMeta(getCacheKey(path, stat), lambda: extractVideoMeta(path, stat))
+
+
+def readFrame(path, stat):
     if not canReadVideos:
         return None
-    frames = imageio.get_reader(path, 'ffmpeg')
-    # we want to grab a frame 2 seconds into the video to avoid potential shaking in the beginning
-    frameOffset = frames.get_meta_data()['fps'] * 2
-    for i, frame in enumerate(frames):
-        lastFrame = frame
-        if i >= frameOffset:
-            break
-    return lastFrame
+    # we want to grab a frame 2 seconds into the video to avoid potential shaking in the beginning,
+    # ffmpeg seeks there from the preceding keyframe instead of us decoding every frame before it
+    probe, frame = grabFrame(path, ['-ss', str(VIDEO_FRAME_OFFSET)])
+    if frame is None:
+        # the video is shorter, take the last frame like when counting the frames
+        probe, frame = grabFrame(path, [], math.ceil(
+            probe['fps'] * VIDEO_FRAME_OFFSET) + 1)
+    # the header came with the frame, so that the metadata does not need to run ffmpeg again
+    getCachedMeta(getCacheKey(path, stat) + ('probe',), lambda: probe)
+    return frame
+
+
+def probeVideo(path):
+    probe, _ = grabFrame(path, [], 0)
+    return probe
+
+
+def grabFrame(path, inputParams, frameCount=1):
+    with measureStage(STAGE_VIDEO, path), openFrames(path, inputParams, frameCount) as (header, frames):
+        frame = None
+        for i in range(frameCount):
+            frame = next(frames, frame)
+    probe = {field: header.get(field, None) for field in VIDEO_PROBE_FIELDS}
+    if frame is not None:
+        frame = numpy.frombuffer(frame, numpy.uint8).reshape(
+            probe['size'][1], probe['size'][0], 3)
+    return probe, frame
+
+
+@contextlib.contextmanager
+def openFrames(path, inputParams, frameCount):
+    # imageio-ffmpeg closes the pipes of ffmpeg only while it is still running and never its error output,
+    # so they are closed here once the reader is done, also when it failed on the header
+    frames = imageio_ffmpeg.read_frames(
+        path, input_params=inputParams, output_params=['-frames:v', str(max(frameCount, 1))])
+    process = None
+    try:
+        header = next(frames)
+        process = frames.gi_frame.f_locals['p']
+        yield header, frames
+    except Exception as error:
+        if process is None:
+            process = findFramesProcess(error.__traceback__)
+        raise
+    finally:
+        frames.close()
+        if process is not None:
+            for pipe in [process.stdin, process.stdout, process.stderr]:
+                pipe.close()
+
+
+def findFramesProcess(traceback):
+    while traceback is not None:
+        if traceback.tb_frame.f_code is imageio_ffmpeg.read_frames.__code__:
+            return traceback.tb_frame.f_locals.get('p', None)
+        traceback = traceback.tb_next
+    return None
 
 
-def makeThumbnail(image, size):
-    WHITE = [255, 255, 255]
-    # crop longest edge
-    h, w = image.shape[0:2]
-    dw = max(w - min(w, h), 0)
-    dh = max(h - min(w, h), 0)
-    image = image[math.floor(dh / 2):(h - math.ceil(dh / 2)),
-                  math.floor(dw / 2): (w - math.ceil(dw / 2))]
+def resizeThumbnail(image, path):
+    with measureStage(STAGE_RESIZE, path):
+        return getTask().generator.backend.thumbnail(image, THUMBNAIL_SIZE)
+
+
+def makeThumbnail(image, size, interpolation=cv2.INTER_LINEAR, flatten=None):
+    image = cropSquare(image)
     # scale to size
     h, w = image.shape[0: 2]
     scale = max(h, w, size) / size
     image = cv2.resize(image, (min(math.ceil(w / scale), size),
-                               min(math.ceil(h / scale), size)))
-    # get rid of alpha channel, replace with white
-    if len(image.shape) > 2 and image.shape[2] > 3:
-        white = numpy.array(WHITE)
-        alpha = (image[:, :, 3] / 255).reshape(image.shape[: 2] + (1,))
-        image = ((white * (1 - alpha)) +
-                 (image[:, :, :3] * alpha)).astype(numpy.uint8)
+                               min(math.ceil(h / scale), size)), interpolation=interpolation)
+    image = (flatten or removeAlpha)(image)
     # pad small images
     h, w = image.shape[0:2]
     dh = size - h
@@ -237,59 +1283,156 @@ def makeThumbnail(image, size):
     return image
 
 
-def extractAlbumMeta(path):
+def cropSquare(image):
+    # crop longest edge
+    h, w = image.shape[0:2]
+    dw = max(w - min(w, h), 0)
+    dh = max(h - min(w, h), 0)
+    return image[math.floor(dh / 2):(h - math.ceil(dh / 2)),
+                 math.floor(dw / 2): (w - math.ceil(dw / 2))]
+
+
+def removeAlpha(image):
+    # get rid of alpha channel, replace with white
+    if len(image.shape) > 2 and image.shape[2] > 3:
+        white = numpy.array(WHITE)
+        alpha = (image[:, :, 3] / 255).reshape(image.shape[: 2] + (1,))
+        image = ((white * (1 - alpha)) +
+                 (image[:, :, :3] * alpha)).astype(numpy.uint8)
+    return image
+
+
+def blendAlpha(image):
+    # the same as removeAlpha, rounded and in 16 bit integers instead of a float64 copy of the image
+    if len(image.shape) > 2 and image.shape[2] > 3:
+        alpha = image[:, :, 3:4].astype(numpy.uint16)
+        image = ((image[:, :, :3] * alpha + WHITE[0] * (255 - alpha) + 127) // 255).astype(numpy.uint8)
+    return image
+
+
+class ImageBackend:
+    # decodes the images and scales them down to previews, thumbnails and pinkynails;
+    # this one is what the generator always did, the others are in BACKENDS
+
+    def decode(self, path, size=None):
+        return decodeImage(path, size)
+
+    def resize(self, image, width, height):
+        return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+    def flatten(self, image):
+        return removeAlpha(image)
+
+    def thumbnail(self, image, size):
+        return makeThumbnail(image, size)
+
+
+class OpenCVBackend(ImageBackend):
+    # averages the pixels when scaling down instead of interpolating between a few of them
+
+    def flatten(self, image):
+        return blendAlpha(image)
+
+    def thumbnail(self, image, size):
+        return makeThumbnail(image, size, cv2.INTER_AREA, blendAlpha)
+
+
+class PillowBackend(ImageBackend):
+    # decodes JPEG images in draft mode and reduces the other images by an integer factor while
+    # converting them, then scales down with Pillow's antialiasing filter
+
+    def decode(self, path, size=None):
+        if size is None:
+            return decodeImage(path, size)
+        with measureStage(STAGE_DECODE, path), PILImage.open(io.BytesIO(readSource(path))) as image:
+            orientation = None
+            if image.format in EXIF_FORMATS and 'exif' in image.info:
+                orientation = image._getexif().get(EXIF_ORIENTATION, None)
+            if image.format in DRAFT_FORMATS and image.mode in DRAFT_MODES:
+                image.draft(image.mode, (size, size))
+                return rotateImage(numpy.asarray(image), orientation)
+            return rotateImage(reduceImage(image, size), orientation)
+
+    def resize(self, image, width, height):
+        return numpy.asarray(PILImage.fromarray(image).resize((width, height), PILImage.LANCZOS, reducing_gap=2.0))
+
+    def flatten(self, image):
+        return blendAlpha(image)
+
+    def thumbnail(self, image, size):
+        image = PILImage.fromarray(cropSquare(image))
+        image.thumbnail((size, size), PILImage.LANCZOS)
+        tn = PILImage.new('RGB', (size, size), tuple(WHITE))
+        # pad small images
+        offset = (math.floor((size - image.width) / 2),
+                  math.floor((size - image.height) / 2))
+        if image.mode == 'RGBA':
+            tn.paste(image, offset, image)
+        else:
+            tn.paste(image, offset)
+        return numpy.array(tn)
+
+
+BACKENDS = {
+    BACKEND_DEFAULT: ImageBackend,
+    BACKEND_OPENCV: OpenCVBackend,
+    BACKEND_PILLOW: PillowBackend,
+}
+
+
+def extractAlbumMeta(items, base):
     meta = {}
 
-    meta[META_CAPTION] = os.path.basename(path)
+    meta[META_CAPTION] = os.path.basename(items[PATH])
     meta[META_ITEMS] = {}
-    items = getItems(path)
     for album in items[ALBUM]:
-        itemId = getMetaId(album)
+        itemId = getMetaId(album[PATH], base)
         meta[META_ITEMS][itemId] = {
-            META_CAPTION: os.path.basename(album),
-            META_DATE: getLatestAlbumItemDate(album).isoformat(' '),
+            META_CAPTION: os.path.basename(album[PATH]),
+            META_DATE: album[LATEST_DATE].isoformat(' '),
         }
     for image in items[IMAGE]:
-        itemId = getMetaId(image)
+        itemId = getMetaId(image, base)
         meta[META_ITEMS][itemId] = trimToAlbumItemMeta(
-            extractImageMeta(image, imageio.imread(image)))
+            getImageMeta(image, items[STATS][image]))
     for video in items[VIDEO]:
         for itemVideo in video[VIDEO]:
-            itemId = getMetaId(itemVideo)
+            itemId = getMetaId(itemVideo, base)
             meta[META_ITEMS][itemId] = trimToAlbumItemMeta(
-                extractVideoMeta(itemVideo))
+                getVideoMeta(itemVideo, items[STATS][itemVideo]))
         if video[IMAGE]:
-            posterMeta = trimToAlbumItemMeta(extractImageMeta(
-                video[IMAGE], imageio.imread(video[IMAGE])))
+            posterMeta = trimToAlbumItemMeta(getImageMeta(
+                video[IMAGE], items[STATS][video[IMAGE]]))
             for itemVideo in video[VIDEO]:
-                itemId = getMetaId(itemVideo)
+                itemId = getMetaId(itemVideo, base)
                 meta[META_ITEMS][itemId].update(posterMeta)
-            posterId = getMetaId(video[IMAGE])
+            posterId = getMetaId(video[IMAGE], base)
             meta[META_ITEMS][posterId] = posterMeta
 
     return meta
 
 
-def getLatestAlbumItemDate(path):
+def getLatestAlbumItemDate(items):
+    # the latest dates of the subalbums have to be already known
     latestDate = datetime.fromtimestamp(0)
-    items = getItems(path)
     for album in items[ALBUM]:
-        latestDate = max(getLatestAlbumItemDate(album), latestDate)
+        latestDate = max(album[LATEST_DATE], latestDate)
     for image in items[IMAGE]:
-        metaDate = extractImageMeta(image, imageio.imread(image))[META_DATE]
+        metaDate = getImageMeta(image, items[STATS][image])[META_DATE]
         latestDate = max(dateutil.parser.isoparse(metaDate), latestDate)
     for video in items[VIDEO]:
         if video[IMAGE]:
-            metaDate = extractImageMeta(
-                video[IMAGE], imageio.imread(video[IMAGE]))[META_DATE]
+            metaDate = getImageMeta(
+                video[IMAGE], items[STATS][video[IMAGE]])[META_DATE]
             latestDate = max(dateutil.parser.isoparse(metaDate), latestDate)
         else:
             for itemVideo in video[VIDEO]:
-                metaDate = extractVideoMeta(itemVideo)[META_DATE]
+                metaDate = getVideoMeta(
+                    itemVideo, items[STATS][itemVideo])[META_DATE]
                 latestDate = max(
                     dateutil.parser.isoparse(metaDate), latestDate)
     if latestDate == datetime.fromtimestamp(0):
-        latestDate = datetime.fromtimestamp(os.path.getmtime(path))
+        latestDate = datetime.fromtimestamp(items[STAT].st_mtime)
     return latestDate
 
 
@@ -301,14 +1444,33 @@ def trimToAlbumItemMeta(fullMeta):
     return meta
 
 
-def extractImageMeta(path, image):
-    meta = {}
-    meta[META_HEIGHT] = image.shape[0]
-    meta[META_WIDTH] = image.shape[1]
+def extractImageMeta(path, stat):
+    # opening the image with PIL only parses the headers, the pixels are never decoded
+    with measureStage(STAGE_EXIF, path), openSource(path) as f, PILImage.open(f) as image:
+        width, height = image.size
+        exif = None
+        if image.format in EXIF_FORMATS and 'exif' in image.info:
+            exif = {}
+            for tag, value in image._getexif().items():
+                exif[ExifTags.TAGS.get(tag, tag)] = value
+    # imageio rotates JPEG images according to their EXIF orientation
+    if exif is not None and exif.get('Orientation', None) in EXIF_TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    return parseImageMeta(path, width, height, exif, stat)
 
-    iptc = iptcinfo3.IPTCInfo(path)
-    if iptc and not iptc.inp_charset:
-        iptc = iptcinfo3.IPTCInfo(path, inp_charset='utf-8')
+
+def parseImageMeta(path, width, height, exif, stat):
+    meta = {}
+    meta[META_HEIGHT] = height
+    meta[META_WIDTH] = width
+
+    # the parser closes the file it is given
+    with measureStage(STAGE_IPTC, path):
+        with openSource(path) as f:
+            iptc = iptcinfo3.IPTCInfo(f)
+        if iptc and not iptc.inp_charset:
+            with openSource(path) as f:
+                iptc = iptcinfo3.IPTCInfo(f, inp_charset='utf-8')
     if iptc:
         entry = iptc['caption/abstract']
         if entry and len(entry.strip()) > 0:
@@ -317,7 +1479,6 @@ def extractImageMeta(path, image):
         if entry and len(entry.strip()) > 0:
             meta[META_COPYRIGHT] = entry
 
-    exif = image.meta.get('EXIF_MAIN', None)
     if exif is not None:
         entry = exif.get('DateTimeOriginal', None)
         if entry is not None:
@@ -367,7 +1528,7 @@ def extractImageMeta(path, image):
         meta[META_CAPTION] = os.path.basename(path)
     if not (META_DATE in meta):
         meta[META_DATE] = datetime.fromtimestamp(
-            os.path.getmtime(path)).isoformat(' ')
+            stat.st_mtime).isoformat(' ')
 
     return meta
 
@@ -388,62 +1549,947 @@ def exifDegreeToDecimal(degrees):
     return None
 
 
-def extractVideoMeta(path):
+def extractVideoMeta(path, stat):
     if not canReadVideos:
         return {}
     meta = {}
 
-    frames = imageio.get_reader(path, 'ffmpeg')
-    entry = frames.get_meta_data().get('size', None)
+    entry = getVideoProbe(path, stat)['size']
     if entry is not None:
         meta[META_HEIGHT] = entry[1]
         meta[META_WIDTH] = entry[0]
-    meta[META_SIZE] = os.path.getsize(path)
+    meta[META_SIZE] = stat.st_size
 
     if not (META_CAPTION in meta):
         meta[META_CAPTION] = os.path.basename(path)
     if not (META_DATE in meta):
         meta[META_DATE] = datetime.fromtimestamp(
-            os.path.getmtime(path)).isoformat(' ')
+            stat.st_mtime).isoformat(' ')
 
     return meta
 
 
-def outputMeta(meta, path):
-    dst = getMetaDir(path)
-    if not os.path.exists(dst):
-        os.makedirs(dst)
-    with open(os.path.join(dst, METADATA_FILE), 'w', encoding='utf-8') as metaFile:
-        json.dump(meta, metaFile, ensure_ascii=False, indent=4, sort_keys=True)
+def outputMeta(meta, path, base):
+    dst = makeMetaDir(path, base)
+    formats = getTask().generator.formats
+    if formats:
+        # the formats of the thumbnails, previews and sprites next to the metadata in the order of preference,
+        # wag.php serves only these
+        meta = dict(meta)
+        meta[META_FORMATS] = [FORMAT_TYPES[fmt]
+                              for fmt in formats] + [FORMAT_TYPES[FORMAT_JPEG]]
+    writeFile(os.path.join(dst, METADATA_FILE), json.dumps(
+        meta, ensure_ascii=False, indent=4, sort_keys=True).encode('utf-8'))
+
+
+def outputThumbnail(image, path, base, fileName=THUMBNAIL_FILE):
+    dst = makeMetaDir(path, base)
+    for fmt, name in zip([FORMAT_JPEG] + getTask().generator.formats, getFormatFiles(fileName)):
+        with measureStage(STAGE_ENCODE, path):
+            data = encodeImage(image, fmt)
+        writeFile(os.path.join(dst, name), data)
+
+
+def removeOtherDerivatives(dst, fileNames):
+    # the files written by earlier runs only, in formats or of sizes no longer configured
+    try:
+        names = os.listdir(dst)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name not in fileNames and isDerivative(name):
+            getTask().generator.sink.remove(os.path.join(dst, name))
+
+
+def isDerivative(name):
+    stem, ext = os.path.splitext(name)
+    if ext not in FORMAT_EXT.values():
+        return False
+    for fileName in DERIVATIVE_FILES:
+        prefix, number, suffix = os.path.splitext(fileName)[0].partition('{}')
+        if not number and stem == prefix:
+            return True
+        if number and stem.startswith(prefix) and stem.endswith(suffix) and \
+                stem[len(prefix):len(stem) - len(suffix)].isdigit():
+            return True
+    return False
+
+
+def getFormatFiles(fileName):
+    # the JPEG file followed by the files of the other formats
+    stem = os.path.splitext(fileName)[0]
+    return [fileName] + [stem + FORMAT_EXT[fmt] for fmt in getTask().generator.formats]
+
+
+def encodeImage(image, fmt):
+    # JPEG is written by imageio unless it is tuned, the other formats by Pillow with its defaults
+    # unless the quality is given
+    generator = getTask().generator
+    if fmt == FORMAT_JPEG and not generator.jpegSettings:
+        return imageio.imwrite(imageio.RETURN_BYTES, image, format=FORMAT_EXT[FORMAT_JPEG])
+    settings = generator.jpegSettings if fmt == FORMAT_JPEG else {}
+    if generator.quality is not None:
+        settings = dict(settings, quality=generator.quality)
+    output = io.BytesIO()
+    PILImage.fromarray(image).save(output, FORMAT_PIL[fmt], **settings)
+    return output.getvalue()
+
+
+def writeFile(path, data):
+    with measureStage(STAGE_WRITE, path):
+        getTask().generator.sink.write(path, data)
+
+
+def measureStage(stage, path):
+    # without --stats, the stages run in a shared no-op context
+    if not getTask().generator.measureStages:
+        return NO_STAGE
+    return recordStage(stage, path)
+
+
+@contextlib.contextmanager
+def recordStage(stage, path):
+    # the time of nested stages is accounted to them only, so that the stages add up;
+    # the totals are kept in the cache statistics to be passed back from worker processes, see runTask
+    task = getTask()
+    counters = task.counters
+    outerStages = task.nestedStages
+    task.nestedStages = collections.Counter()
+    bytesRead = counters['bytesRead']
+    bytesWritten = counters['bytesWritten']
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    try:
+        yield
+    finally:
+        total = collections.Counter({
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+            'bytesRead': counters['bytesRead'] - bytesRead,
+            'bytesWritten': counters['bytesWritten'] - bytesWritten,
+        })
+        own = total.copy()
+        own.subtract(task.nestedStages)
+        task.nestedStages = outerStages
+        if outerStages is not None:
+            outerStages.update(total)
+        own['calls'] = 1
+        for field, value in own.items():
+            counters[(stage, field)] += value
+        counters[(stage, STAGE_SLOWEST, path)] = max(
+            own['wall'], counters[(stage, STAGE_SLOWEST, path)])
+
+
+def trimSlowest(counters):
+    # only the slowest files of every stage are kept
+    slowest = collections.defaultdict(list)
+    for key, value in counters.items():
+        if isinstance(key, tuple) and len(key) == 3:
+            slowest[key[0]].append((value, key))
+    for entries in slowest.values():
+        entries.sort(reverse=True)
+        for _, key in entries[SLOWEST_FILES:]:
+            del counters[key]
+
+
+def getStageReport(counters):
+    trimSlowest(counters)
+    report = {}
+    for key, value in counters.items():
+        if not isinstance(key, tuple):
+            continue
+        stage = report.setdefault(key[0], dict(
+            {field: 0 for field in STAGE_FIELDS}, **{STAGE_SLOWEST: []}))
+        if len(key) == 3:
+            stage[STAGE_SLOWEST].append([key[2], value])
+        else:
+            stage[key[1]] = value
+    for stage in report.values():
+        stage[STAGE_SLOWEST].sort(key=lambda entry: entry[1], reverse=True)
+    return report
+
+
+def getMemoryReport():
+    current, peak = tracemalloc.get_traced_memory()
+    statistics = tracemalloc.take_snapshot().statistics('lineno')
+    return {
+        'current': current,
+        'peak': peak,
+        'top': [[str(entry.traceback), entry.size, entry.count] for entry in statistics[:MEMORY_TOP]],
+    }
 
 
-def outputThumbnail(image, path):
-    dst = getMetaDir(path)
+def printStats(report, fmt, out):
+    if fmt == 'json':
+        json.dump(report, out, indent=4, sort_keys=True)
+        print(file=out)
+        return
+    print('{:10} {:>8} {:>10} {:>10} {:>12} {:>12}'.format(
+        'stage', 'calls', 'wall s', 'cpu s', 'read MB', 'written MB'), file=out)
+    stages = sorted(report['stages'].items(),
+                    key=lambda entry: entry[1]['wall'], reverse=True)
+    for name, stage in stages:
+        print('{:10} {:8d} {:10.3f} {:10.3f} {:12.1f} {:12.1f}'.format(
+            name, stage['calls'], stage['wall'], stage['cpu'],
+            stage['bytesRead'] / 1024 / 1024, stage['bytesWritten'] / 1024 / 1024), file=out)
+    print('{:10} {:8} {:10.3f}'.format('total', '', report['wall']), file=out)
+    for name, stage in stages:
+        print(file=out)
+        print('Slowest {}:'.format(name), file=out)
+        for path, wall in stage[STAGE_SLOWEST]:
+            print('{:10.3f}  {}'.format(wall, path), file=out)
+    if 'memory' in report:
+        print(file=out)
+        print('Traced memory: {:.1f} MB, peak {:.1f} MB'.format(
+            report['memory']['current'] / 1024 / 1024, report['memory']['peak'] / 1024 / 1024), file=out)
+        for line, size, count in report['memory']['top']:
+            print('{:10.1f} MB {:8d}  {}'.format(
+                size / 1024 / 1024, count, line), file=out)
+
+
+def getMetaDir(path, base):
+    return os.path.join(base, WAG_DIR, getMetaId(path, base))
+
+
+def makeMetaDir(path, base):
+    dst = getMetaDir(path, base)
     if not os.path.exists(dst):
         os.makedirs(dst)
-    imageio.imwrite(os.path.join(dst, THUMBNAIL_FILE), image)
-
-
-def getMetaDir(path):
-    global processingBase
-
-    return os.path.join(processingBase, WAG_DIR, getMetaId(path))
-
+    return dst
+
+
+def getMetaId(path, base):
+    return hashlib.md5(getManifestKey(path, base).encode('utf-8')).hexdigest()
+
+
+def getFileMode():
+    # temporary files are created private, the output gets the mode of files created as usual
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+FILE_MODE = getFileMode()
+
+
+class FileSink:
+    # writes the output files, see MetaGenerator
+
+    def write(self, path, data):
+        # unchanged files keep their modification time, so that mirrors do not transfer them again;
+        # changed files are replaced at once, which leaves linked files alone and readers never see a partial file
+        counters = getTask().counters
+        try:
+            if os.path.getsize(path) == len(data):
+                with open(path, 'rb') as f:
+                    if f.read() == data:
+                        counters['bytesSkipped'] += len(data)
+                        return
+        except OSError:
+            pass
+        # the temporary file is unique, as other processes may write the same file
+        fd, tmpPath = tempfile.mkstemp(
+            suffix=TMP_SUFFIX, dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmpPath, FILE_MODE)
+            os.replace(tmpPath, path)
+        except BaseException:
+            os.remove(tmpPath)
+            raise
+        counters['bytesWritten'] += len(data)
+
+    def link(self, src, dst):
+        if os.path.isfile(dst) and filecmp.cmp(src, dst, shallow=False):
+            getTask().counters['bytesSkipped'] += os.path.getsize(dst)
+            return
+        # a link cannot replace a file, so it is made under a name unique to the thread
+        tmpPath = '{}.{}-{}{}'.format(dst, os.getpid(),
+                                      threading.get_ident(), TMP_SUFFIX)
+        if os.path.lexists(tmpPath):
+            os.remove(tmpPath)
+        makeLink(src, tmpPath)
+        os.replace(tmpPath, dst)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def flush(self):
+        # the counters of work finished in the background, there is none
+        return collections.Counter()
+
+    def close(self):
+        return self.flush()
+
+
+class UploadSink(FileSink):
+    # writes the output files and uploads the changed ones to an S3 compatible storage, e.g. Backblaze B2,
+    # at the URL of the bucket and the folder of the gallery in it; the MD5 of the uploaded objects are
+    # appended to a local record, so that only the objects which changed since are uploaded again;
+    # the uploads run in a pool of threads, each reusing its connection, and worker processes wait for
+    # the uploads of a task before returning its result
+
+    def __init__(self, url, accessKey, secretKey, region, record, jobs=UPLOAD_JOBS, retries=UPLOAD_RETRIES):
+        self.config = {
+            'url': url,
+            'accessKey': accessKey,
+            'secretKey': secretKey,
+            'region': region,
+            'record': record,
+            'jobs': jobs,
+            'retries': retries,
+        }
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.root = parts.path.rstrip('/')
+        self.accessKey = accessKey
+        self.secretKey = secretKey
+        self.region = region
+        self.record = record
+        self.jobs = max(jobs, 1)
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.uploaded = None
+        self.pending = {}
+        self.counters = collections.Counter()
+        self.executor = None
+        # bounds the data waiting for an upload
+        self.slots = threading.BoundedSemaphore(2 * self.jobs)
+        self.connections = threading.local()
+        self.openConnections = []
+        self.pid = os.getpid()
+
+    def __getstate__(self):
+        # worker processes make their own pool and connections
+        return self.config
+
+    def __setstate__(self, config):
+        self.__init__(**config)
+
+    def checkProcess(self):
+        # forked worker processes get the sink without pickling it, with the lock possibly held
+        # and the pool without its threads, so they start afresh like unpickled ones
+        if os.getpid() != self.pid:
+            self.__init__(**self.config)
+
+    def write(self, path, data):
+        super().write(path, data)
+        self.upload(path, data)
+
+    def link(self, src, dst):
+        super().link(src, dst)
+        with open(dst, 'rb') as f:
+            self.upload(dst, f.read())
+
+    def upload(self, path, data):
+        self.checkProcess()
+        key = getUploadKey(path)
+        if key is None:
+            return
+        digest = hashlib.md5(data).hexdigest()
+        with self.lock:
+            if self.uploaded is None:
+                self.uploaded = readUploadRecord(self.record)
+            if self.uploaded.get(key, None) == digest or key in self.pending and self.pending[key][0] == digest:
+                self.counters['uploadSkips'] += 1
+                return
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        self.slots.acquire()
+        future = self.executor.submit(self.putObject, key, data, digest)
+        with self.lock:
+            self.pending[key] = (digest, future)
+        future.add_done_callback(lambda _: self.slots.release())
+
+    def uploadMissing(self, base):
+        # the output written before uploading was enabled, or while the uploads failed
+        self.checkProcess()
+        with self.lock:
+            # including the uploads of the worker processes
+            self.uploaded = readUploadRecord(self.record)
+            uploaded = set(self.uploaded.keys()) | set(self.pending.keys())
+        wagDir = os.path.join(base, WAG_DIR)
+        with os.scandir(wagDir) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False) or not isMetaId(entry.name):
+                    continue
+                with os.scandir(entry.path) as files:
+                    for f in files:
+                        # temporary files left by interrupted runs are never uploaded
+                        if f.name.endswith(TMP_SUFFIX):
+                            continue
+                        if getUploadKey(f.path) not in uploaded and f.is_file():
+                            with open(f.path, 'rb') as dataFile:
+                                self.upload(f.path, dataFile.read())
+
+    def putObject(self, key, data, digest):
+        status = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                with self.lock:
+                    self.counters['uploadRetries'] += 1
+                time.sleep(UPLOAD_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                status = self.request('PUT', self.root + '/' + key, data, {
+                    'Content-Type': UPLOAD_TYPES.get(os.path.splitext(key)[1], 'application/octet-stream'),
+                })
+            except (OSError, http.client.HTTPException) as e:
+                status = e
+                self.connections.connection = None
+                continue
+            # throttled or failed by the server, other errors are final
+            if status < 500 and status != 429:
+                break
+        with self.lock:
+            if self.pending.get(key, (None,))[0] == digest:
+                del self.pending[key]
+            if status == 200:
+                self.uploaded[key] = digest
+                with open(self.record, 'a', encoding='utf-8') as f:
+                    f.write(digest + ' ' + key + '\n')
+                self.counters['uploads'] += 1
+                self.counters['uploadBytes'] += len(data)
+                return
+            self.counters['uploadFailures'] += 1
+        print('Cannot upload', key + ':', status, file=sys.stderr)
+
+    def request(self, method, path, data, headers):
+        connection = getattr(self.connections, 'connection', None)
+        if connection is None:
+            connection = (http.client.HTTPSConnection if self.https else http.client.HTTPConnection)(
+                self.host, timeout=UPLOAD_TIMEOUT)
+            self.connections.connection = connection
+            with self.lock:
+                self.openConnections.append(connection)
+        path = urllib.parse.quote(path, safe='/-_.~')
+        headers = dict(headers, **signRequest(method, self.host, path, data,
+                                              self.accessKey, self.secretKey, self.region))
+        connection.request(method, path, body=data, headers=headers)
+        response = connection.getresponse()
+        # the response is read to reuse the connection
+        response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+            self.connections.connection = None
+        return response.status
+
+    def flush(self):
+        # waits for the pending uploads and returns their counters
+        self.checkProcess()
+        with self.lock:
+            futures = [future for _, future in self.pending.values()]
+        concurrent.futures.wait(futures)
+        with self.lock:
+            counters = self.counters
+            self.counters = collections.Counter()
+        return counters
+
+    def close(self):
+        # the record is rewritten with a line per object, including those uploaded by worker processes
+        counters = self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        for connection in self.openConnections:
+            connection.close()
+        self.openConnections = []
+        uploaded = readUploadRecord(self.record)
+        tmpPath = self.record + '.tmp'
+        with open(tmpPath, 'w', encoding='utf-8') as f:
+            for key, digest in sorted(uploaded.items()):
+                f.write(digest + ' ' + key + '\n')
+        os.replace(tmpPath, self.record)
+        return counters
+
+
+def getUploadKey(path):
+    # the objects are named by their path in the gallery, the manifest is kept locally
+    head, sep, tail = path.rpartition(os.sep + WAG_DIR + os.sep)
+    if not sep or os.path.basename(path) == MANIFEST_FILE:
+        return None
+    return WAG_DIR + '/' + tail.replace(os.sep, '/')
+
+
+def readUploadRecord(record):
+    uploaded = {}
+    try:
+        with open(record, encoding='utf-8') as f:
+            for line in f:
+                digest, _, key = line.rstrip('\n').partition(' ')
+                # the last upload of an object wins, a line cut short by an interrupted run is ignored
+                if len(digest) == 32 and key:
+                    uploaded[key] = digest
+    except FileNotFoundError:
+        pass
+    return uploaded
+
+
+def signRequest(method, host, path, data, accessKey, secretKey, region, now=None):
+    # AWS Signature Version 4 of a request without a query, in the headers to add to it
+    now = now if now is not None else datetime.utcnow()
+    amzDate = now.strftime('%Y%m%dT%H%M%SZ')
+    dateStamp = now.strftime('%Y%m%d')
+    payloadHash = hashlib.sha256(data).hexdigest()
+    headers = {
+        'host': host,
+        'x-amz-content-sha256': payloadHash,
+        'x-amz-date': amzDate,
+    }
+    signedHeaders = ';'.join(sorted(headers.keys()))
+    canonicalRequest = '\n'.join([method, path, '', ''.join(
+        '{}:{}\n'.format(name, headers[name]) for name in sorted(headers.keys())), signedHeaders, payloadHash])
+    scope = '/'.join([dateStamp, region, 's3', 'aws4_request'])
+    stringToSign = '\n'.join(['AWS4-HMAC-SHA256', amzDate, scope,
+                              hashlib.sha256(canonicalRequest.encode('utf-8')).hexdigest()])
+    key = ('AWS4' + secretKey).encode('utf-8')
+    for part in [dateStamp, region, 's3', 'aws4_request']:
+        key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(key, stringToSign.encode(
+        'utf-8'), hashlib.sha256).hexdigest()
+    return {
+        'x-amz-content-sha256': payloadHash,
+        'x-amz-date': amzDate,
+        'Authorization': 'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+            accessKey, scope, signedHeaders, signature),
+    }
 
-def getMetaId(path):
-    global processingBase
 
-    relPath = os.path.relpath(path, processingBase)
-    if relPath == '.':
-        relPath = ''
-    return hashlib.md5(relPath.encode('utf-8')).hexdigest()
+class Task:
+    # the generator running a task in the current thread, with the cache statistics and
+    # the metadata extracted by the task and the totals of the stages nested in the current one
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.counters = collections.Counter()
+        self.extractedMeta = {}
+        self.nestedStages = None
+        # the sources being processed, see sharedSource
+        self.sources = {}
+
+
+class MetaGenerator:
+    # generates the metadata of galleries; the caches are shared by all galleries and threads,
+    # while a gallery is processed by one thread at a time
+
+    def __init__(self, hashContents=False, imageCacheSize=IMAGE_CACHE_SIZE, jobs=1, store=None, useStore=False,
+                 pack=False, maxMemory=None, measureStages=False, sink=None, previewSizes=(), formats=(),
+                 quality=None, jpegSubsampling=None, jpegProgressive=False, sprites=False, backend=BACKEND_DEFAULT):
+        # worker processes make their own generator with the same arguments
+        self.config = {
+            'hashContents': hashContents,
+            'imageCacheSize': imageCacheSize,
+            'jobs': jobs,
+            'store': store,
+            'useStore': useStore,
+            'pack': pack,
+            'maxMemory': maxMemory,
+            'measureStages': measureStages,
+            'sink': sink,
+            'previewSizes': previewSizes,
+            'formats': formats,
+            'quality': quality,
+            'jpegSubsampling': jpegSubsampling,
+            'jpegProgressive': jpegProgressive,
+            'sprites': sprites,
+            'backend': backend,
+        }
+        self.hashContents = hashContents
+        self.jobs = max(jobs, 1)
+        self.store = store
+        self.useStore = useStore
+        self.pack = pack
+        self.measureStages = measureStages
+        self.sink = sink if sink is not None else FileSink()
+        self.previewSizes = sorted(set(previewSizes))
+        # the formats besides JPEG in the order of preference, and the settings of their encoders;
+        # tuned JPEG also has optimized Huffman tables
+        self.formats = [fmt for fmt in collections.OrderedDict.fromkeys(formats) if fmt != FORMAT_JPEG]
+        self.quality = quality
+        self.jpegSettings = {}
+        if jpegSubsampling is not None:
+            self.jpegSettings['subsampling'] = JPEG_SUBSAMPLING[jpegSubsampling]
+        if jpegProgressive:
+            self.jpegSettings['progressive'] = True
+        if self.jpegSettings or quality is not None:
+            self.jpegSettings['optimize'] = True
+        self.sprites = sprites
+        self.backend = BACKENDS[backend]()
+        self.encoderConfig = {}
+        if self.formats:
+            self.encoderConfig['formats'] = self.formats
+        if quality is not None:
+            self.encoderConfig['quality'] = quality
+        if self.jpegSettings:
+            self.encoderConfig['jpeg'] = self.jpegSettings
+        # the memory for the items being processed and for a single item
+        self.memoryBudget = None
+        self.itemMemoryBudget = None
+        # decoded images are evicted in LRU order to stay within the cache size,
+        # extracted metadata is small and is kept while its item stays the same
+        self.imageCache = collections.OrderedDict()
+        self.imageCacheBytes = 0
+        self.imageCacheSize = imageCacheSize * 1024 * 1024
+        if maxMemory is not None:
+            self.memoryBudget = maxMemory * 1024 * 1024
+            self.itemMemoryBudget = self.memoryBudget // self.jobs
+            self.imageCacheSize = min(
+                self.imageCacheSize, self.itemMemoryBudget // 4)
+        self.metaCache = {}
+        self.lock = threading.Lock()
+        # the state of the galleries processed so far: the scanned trees, the manifests of the last runs,
+        # the thumbnail archives and the locks of the galleries
+        self.trees = {}
+        self.manifests = {}
+        self.packs = {}
+        self.galleryLocks = {}
+        self.stats = collections.Counter()
+        # the worker processes kept while watching a gallery
+        self.executor = None
+
+    def process(self, base, full=False, compact=False):
+        # processes a whole gallery and returns the counters of the run
+        with self.lockGallery(base):
+            counters, taskCounters, _ = runTask(
+                self, self.processGallery, base, full, compact)
+        counters.update(taskCounters)
+        return self.collectStats(counters)
+
+    def processItems(self, base, paths):
+        # processes the given files or folders of a gallery, added, changed or removed since
+        # the last run, and their albums; the rest of the gallery is not scanned again
+        with self.lockGallery(base):
+            counters, taskCounters, _ = runTask(
+                self, self.processFolders, base, {self.findAlbum(base, path) for path in paths})
+        counters.update(taskCounters)
+        return self.collectStats(counters)
+
+    def getManifest(self, base):
+        return self.manifests.get(base, None)
+
+    def clearCaches(self):
+        with self.lock:
+            self.imageCache.clear()
+            self.imageCacheBytes = 0
+            self.metaCache.clear()
+
+    def lockGallery(self, base):
+        with self.lock:
+            return self.galleryLocks.setdefault(base, threading.Lock())
+
+    def collectStats(self, counters):
+        with self.lock:
+            self.stats.update(counters)
+        return counters
+
+    def getStore(self, base):
+        if not self.useStore:
+            return None
+        return self.store or os.path.join(base, WAG_DIR, STORE_DIR)
+
+    def processGallery(self, base, full, compact):
+        if self.pack:
+            self.packs[base] = readPack(base)
+        previousManifest = makeManifest() if full else readManifest(base, self.hashContents)
+        self.trees[base] = scanAlbum(base)
+        return self.update(base, previousManifest, compact)
+
+    def processFolders(self, base, folders):
+        if base not in self.trees:
+            # nothing is known about the gallery yet, it is compared with its last run
+            if self.pack:
+                self.packs[base] = readPack(base)
+            self.manifests[base] = readManifest(base, self.hashContents)
+            self.trees[base] = scanAlbum(base)
+            return self.update(base, self.manifests[base])
+        self.trees[base] = rescanAlbums(self.trees[base], folders)
+        return self.update(base, self.manifests[base], changed=getChangedAlbums(self.trees[base], folders))
+
+    def findAlbum(self, base, path):
+        # the deepest scanned album holding the path, where its change shows
+        albums = getAlbumPaths(self.trees[base]) if base in self.trees else set()
+        folder = os.path.dirname(path)
+        while folder not in albums and len(folder) > len(base):
+            folder = os.path.dirname(folder)
+        return folder if folder in albums else base
+
+    def update(self, base, previousManifest, compact=False, changed=None):
+        items = self.trees[base]
+        currentManifest = makeManifest(collectSignatures(
+            items, base, self.hashContents, previousManifest[MANIFEST_ENTRIES], changed))
+        counters = self.processTree(items, base, previousManifest,
+                                    currentManifest, self.getStore(base), changed)
+        if self.pack:
+            packThumbnails(base, self.packs[base], previousManifest,
+                           currentManifest, compact)
+        writeManifest(base, self.hashContents, currentManifest)
+        self.manifests[base] = currentManifest
+        self.pruneMetaCache(base, items)
+        return counters
+
+    def pruneMetaCache(self, base, items):
+        # the metadata of items of the gallery which changed or are gone would never be used again
+        stats = {}
+
+        def visit(album):
+            stats.update(album[STATS])
+            for subalbum in album[ALBUM]:
+                visit(subalbum)
+
+        visit(items)
+        prefix = os.path.join(base, '')
+        with self.lock:
+            for key in list(self.metaCache.keys()):
+                path = key[0]
+                if path.startswith(prefix) and (path not in stats or key[:4] != getCacheKey(path, stats[path])):
+                    del self.metaCache[key]
+
+    def processTree(self, items, base, previousManifest, currentManifest, store, changed=None):
+        # the manifests hold the signatures of the items and the latest item dates of the albums,
+        # the latter are filled in for the current manifest
+        # items are processed first and an album is processed once the results of its items
+        # and subalbums are available; with several jobs, the items and the album thumbnails
+        # are generated by worker processes and the album metadata is put together here;
+        # albums which are not among the changed ones were up to date after the previous run
+        counters = collections.Counter()
+        executor = self.executor
+        if executor is None and self.jobs > 1:
+            executor = self.createExecutor(base)
+        pending = {}
+        remaining = {}
+        parents = {}
+        albums = []
+
+        def isUpToDate(paths):
+            for path in paths:
+                key = getManifestKey(path, base)
+                if previousManifest[MANIFEST_ENTRIES].get(key, None) != currentManifest[MANIFEST_ENTRIES][key]:
+                    return False
+                dst = getMetaDir(path, base)
+                if not os.path.isfile(os.path.join(dst, METADATA_FILE)) or not hasThumbnail(path, base):
+                    return False
+            return True
+
+        def collectResult(result):
+            thumbnails, taskCounters, taskMeta = result
+            counters['thumbnails'] += thumbnails
+            counters.update(taskCounters)
+            with self.lock:
+                self.metaCache.update(taskMeta)
+            if self.measureStages:
+                trimSlowest(counters)
+
+        def submit(album, paths, footprint, task, *args):
+            # paths are given for items, None for the album itself
+            isItem = paths is not None
+            if executor is None:
+                collectResult(runTask(self, task, *args))
+                if isItem:
+                    itemDone(album)
+            else:
+                # items are submitted while their estimated memory stays within the budget,
+                # one item is always let through, however large
+                while self.memoryBudget is not None and len(pending) > 0 and \
+                        sum(entry[2] for entry in pending.values()) + footprint > self.memoryBudget:
+                    collectDone()
+                if executor is self.executor and not isItem:
+                    # album thumbnails are put together from the packed thumbnails of their items
+                    future = executor.submit(
+                        runPackedTask, {base: self.packs.get(base, None)}, task, *args)
+                elif isItem:
+                    # e.g., the content hashes of the signatures are not computed again for the store
+                    future = executor.submit(
+                        runSeededTask, self.getItemMeta(album, paths), task, *args)
+                else:
+                    future = executor.submit(runTask, None, task, *args)
+                pending[future] = (album, isItem, footprint)
+
+        def collectDone():
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                album, isItem, _ = pending.pop(future)
+                collectResult(future.result())
+                if isItem:
+                    itemDone(album)
+
+        def itemDone(album):
+            remaining[album[PATH]] -= 1
+            if remaining[album[PATH]] == 0:
+                albumReady(album)
+
+        def albumReady(album):
+            # albums become ready in post-order, so the latest dates of subalbums are known;
+            # the date of an unchanged album is taken from the previous run
+            counters['items'] += 1
+            key = getManifestKey(album[PATH], base)
+            if isUnchanged(album) and key in previousManifest[MANIFEST_DATES]:
+                album[LATEST_DATE] = dateutil.parser.isoparse(
+                    previousManifest[MANIFEST_DATES][key])
+                currentManifest[MANIFEST_DATES][key] = previousManifest[MANIFEST_DATES][key]
+                counters['skipped'] += 1
+                if album[PATH] in parents:
+                    itemDone(parents[album[PATH]])
+                return
+            upToDate = isUpToDate([album[PATH]])
+            if upToDate and key in previousManifest[MANIFEST_DATES]:
+                album[LATEST_DATE] = dateutil.parser.isoparse(
+                    previousManifest[MANIFEST_DATES][key])
+            else:
+                album[LATEST_DATE], taskCounters, _ = runTask(
+                    self, getLatestAlbumItemDate, album)
+                counters.update(taskCounters)
+            currentManifest[MANIFEST_DATES][key] = album[LATEST_DATE].isoformat(
+                ' ')
+            # the listing follows the folder even when the album is up to date
+            _, taskCounters, _ = runTask(self, outputListing, album, base)
+            counters.update(taskCounters)
+            if upToDate:
+                counters['skipped'] += 1
+            else:
+                meta, taskCounters, _ = runTask(
+                    self, extractAlbumMeta, album, base)
+                counters.update(taskCounters)
+                submit(album, None, 0, processAlbum,
+                       trimToAlbumThumbnailItems(album), meta, base)
+            if album[PATH] in parents:
+                itemDone(parents[album[PATH]])
+
+        def isUnchanged(album):
+            return changed is not None and album[PATH] not in changed
+
+        def visit(album):
+            for subalbum in album[ALBUM]:
+                parents[subalbum[PATH]] = album
+                visit(subalbum)
+            albums.append(album)
+
+        visit(items)
+        try:
+            for album in albums:
+                # the album itself is accounted for so that it cannot become ready while being submitted
+                remaining[album[PATH]] = 1 + len(album[ALBUM])
+            for album in albums:
+                counters['items'] += len(album[IMAGE])
+                if isUnchanged(album):
+                    count = len(album[IMAGE]) + sum(len(video[VIDEO]) + (1 if video[IMAGE] else 0)
+                                                    for video in album[VIDEO])
+                    counters['items'] += count - len(album[IMAGE])
+                    counters['skipped'] += count
+                    itemDone(album)
+                    continue
+                for image in album[IMAGE]:
+                    if isUpToDate([image]):
+                        counters['skipped'] += 1
+                    else:
+                        remaining[album[PATH]] += 1
+                        submit(album, [image], self.getFootprint([image], executor), processImage, image,
+                               album[STATS][image], base, store)
+                for video in album[VIDEO]:
+                    group = video[VIDEO] + \
+                        ([video[IMAGE]] if video[IMAGE] else [])
+                    counters['items'] += len(group)
+                    if isUpToDate(group):
+                        counters['skipped'] += len(group)
+                    else:
+                        remaining[album[PATH]] += 1
+                        submit(album, group, self.getFootprint(group, executor), processVideo, video,
+                               {path: album[STATS][path] for path in group}, base, store)
+                itemDone(album)
+            while len(pending) > 0:
+                collectDone()
+        finally:
+            if executor is not None and executor is not self.executor:
+                executor.shutdown()
+        return counters
+
+    def createExecutor(self, base):
+        return concurrent.futures.ProcessPoolExecutor(
+            self.jobs, initializer=initWorker, initargs=(self.config, {base: self.packs.get(base, None)}))
+
+    def getItemMeta(self, album, paths):
+        with self.lock:
+            return {key: self.metaCache[key] for key in
+                    [getCacheKey(path, album[STATS][path]) + ('hash',) for path in paths]
+                    if key in self.metaCache}
+
+    def getFootprint(self, paths, executor):
+        # only the memory of items run by worker processes is accounted for
+        if self.memoryBudget is None or executor is None:
+            return 0
+        footprint = 0
+        # the poster images of videos have no previews
+        previewSizes = () if any(isvideo(path) for path in paths) else self.previewSizes
+        for path in paths:
+            if isvideo(path):
+                footprint = max(footprint, VIDEO_FOOTPRINT)
+                continue
+            try:
+                with PILImage.open(path) as image:
+                    footprint = max(footprint, estimateItemFootprint(
+                        image, previewSizes, self.itemMemoryBudget))
+            except OSError:
+                pass
+        return footprint
+
+    def watch(self, base, stop=None):
+        # the scanned tree is kept and only the folders with changed entries are scanned again,
+        # the manifest then limits the processing to the changed items and their parent albums
+        inotify = inotify_simple.INotify()
+        mask = inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.ATTRIB | inotify_simple.flags.CREATE | \
+            inotify_simple.flags.DELETE | inotify_simple.flags.MOVED_FROM | inotify_simple.flags.MOVED_TO
+        # the worker processes are started once for the whole watch
+        if self.jobs > 1:
+            self.executor = self.createExecutor(base)
+        try:
+            if base not in self.trees:
+                self.processItems(base, [])
+            watches = watchAlbums(inotify, self.trees[base], {}, mask)
+            while stop is None or not stop.is_set():
+                events = inotify.read(timeout=WATCH_POLL * 1000)
+                if not events:
+                    continue
+                # a burst of events is collected until it settles, but not indefinitely
+                start = time.perf_counter()
+                folders = set()
+                while events:
+                    folders.update(getChangedFolders(events, watches, base))
+                    delay = min(WATCH_DELAY, WATCH_MAX_DELAY -
+                                (time.perf_counter() - start))
+                    if delay <= 0:
+                        break
+                    events = inotify.read(timeout=int(delay * 1000))
+                if not folders:
+                    continue
+                collected = time.perf_counter()
+                with self.lockGallery(base):
+                    counters, taskCounters, _ = runTask(
+                        self, self.processFolders, base, folders)
+                counters.update(taskCounters)
+                counters.update(self.sink.flush())
+                self.collectStats(counters)
+                watches = watchAlbums(inotify, self.trees[base], watches, mask)
+                printCounters(counters)
+                print('Update time: {:.3f} s'.format(
+                    time.perf_counter() - collected))
+                print('Latency: {:.3f} s'.format(time.perf_counter() - start))
+                sys.stdout.flush()
+        finally:
+            inotify.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+# the generator of functions called outside of a generator run, e.g. by benchmarks
+defaultGenerator = MetaGenerator()
 
 
 def main(argv=None):
-    global processingBase
-    global totalItems
-    global thumbnailsGenerated
-
     if argv is None:
         ourArgv = sys.argv[1:]
     else:
@@ -452,13 +2498,232 @@ def main(argv=None):
         description='Process a folder to extract metadata for WebAlbumGenarator')
     parser.add_argument('folder',
                         help='folder to process')
+    parser.add_argument('--full', action='store_true',
+                        help='regenerate everything, even items that did not change since the last run')
+    parser.add_argument('--hash', action='store_true',
+                        help='also compare content hashes to detect changed items')
+    parser.add_argument('--image-cache', type=int, default=IMAGE_CACHE_SIZE, metavar='MB',
+                        help='memory for keeping decoded images between processing stages, '
+                        'off by default as every item is decoded only once (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                        help='number of worker processes generating thumbnails (default: %(default)s)')
+    parser.add_argument('--max-memory', type=int, metavar='MB',
+                        help='memory for decoding the items processed at the same time, estimated from their headers; '
+                        'images too large for a single job are decoded in tiles, and the image cache is limited to a quarter of it')
+    parser.add_argument('--store', nargs='?', const='', metavar='DIR',
+                        help='reuse thumbnails of items with the same content, e.g. of moved items, kept in a folder '
+                        'which may be shared by several folders on the same file system; the content of every '
+                        'item is hashed (default: ' + os.path.join(WAG_DIR, STORE_DIR) + ' in the folder)')
+    parser.add_argument('--previews', type=lambda x: [int(size) for size in x.split(',')], default=[], metavar='SIZE[,SIZE...]',
+                        help='also write scaled-down copies of the images with the given lengths of the longer edge, '
+                        'for the image view to load the smallest one covering the screen')
+    parser.add_argument('--formats', type=lambda x: x.split(','), default=[], metavar='FORMAT[,FORMAT...]',
+                        help='also write the thumbnails and previews in these formats, in the order of preference: ' +
+                        ', '.join([FORMAT_WEBP, FORMAT_AVIF]) + ' (AVIF requires pillow-avif-plugin)')
+    parser.add_argument('--quality', type=int, metavar='Q',
+                        help='quality of the thumbnails and previews in all formats (default: the default of every encoder)')
+    parser.add_argument('--jpeg-subsampling', choices=sorted(JPEG_SUBSAMPLING.keys()),
+                        help='chroma subsampling of the JPEG thumbnails and previews')
+    parser.add_argument('--jpeg-progressive', action='store_true',
+                        help='write progressive JPEG thumbnails and previews')
+    parser.add_argument('--sprites', action='store_true',
+                        help='also tile the thumbnails of the items of every album into a few sprite sheets')
+    parser.add_argument('--backend', choices=sorted(BACKENDS.keys()), default=BACKEND_DEFAULT,
+                        help='how the images are decoded and scaled down: ' + BACKEND_DEFAULT + ' with OpenCV '
+                        'bilinear scaling, ' + BACKEND_OPENCV + ' with OpenCV area averaging, ' + BACKEND_PILLOW +
+                        ' with Pillow reducing and antialiasing (default: %(default)s)')
+    parser.add_argument('--pack', action='store_true',
+                        help='keep the thumbnails in a single archive instead of a file per item, served by wag.php '
+                        '(not with --upload)')
+    parser.add_argument('--compact', action='store_true',
+                        help='rewrite the thumbnail archive without replaced thumbnails (with --pack)')
+    parser.add_argument('--upload', metavar='URL',
+                        help='also upload the changed output to an S3 compatible storage, at the URL of the bucket '
+                        'and folder of the gallery, e.g. https://s3.us-west-002.backblazeb2.com/bucket/gallery; '
+                        'the keys are read from AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY')
+    parser.add_argument('--upload-region', default=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'), metavar='REGION',
+                        help='region of the storage (default: AWS_DEFAULT_REGION or us-east-1)')
+    parser.add_argument('--upload-jobs', type=int, default=UPLOAD_JOBS, metavar='N',
+                        help='concurrent uploads (default: %(default)s)')
+    parser.add_argument('--gc', action='store_true',
+                        help='remove the output of items which are no longer in the folder, and the stored thumbnails used only by it')
+    parser.add_argument('--gc-dry-run', action='store_true',
+                        help='only list the output of items which are no longer in the folder')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and update the changed items and their albums (requires inotify_simple)')
+    parser.add_argument('--stats', choices=['text', 'json'],
+                        help='report the time, calls and bytes of every stage and the slowest files to stderr')
+    parser.add_argument('--stats-file', metavar='FILE',
+                        help='write the --stats report to a file instead')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write a cProfile profile of the main process, to be read with pstats')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='trace the memory allocations of the main process and add the largest ones to --stats')
     args = parser.parse_args(ourArgv)
-    processingBase = args.folder
-    totalItems = 0
-    thumbnailsGenerated = 0
-    process(processingBase)
-    print('Total items:', totalItems)
-    print('Thumbnails generated:', thumbnailsGenerated)
+    for fmt in args.formats:
+        if fmt not in FORMAT_EXT:
+            parser.error('unknown format: ' + fmt)
+        if (fmt == FORMAT_WEBP and not canWriteWebp) or (fmt == FORMAT_AVIF and not canWriteAvif):
+            parser.error('cannot write ' + fmt + ', Pillow lacks the encoder')
+    if args.pack and args.upload:
+        # the bucket serves the files as they are, it cannot look up thumbnails in the archive
+        parser.error('--pack cannot be combined with --upload')
+    base = args.folder
+    if args.watch and not canWatch:
+        print('Cannot watch the folder without inotify_simple', file=sys.stderr)
+        return
+    sink = None
+    if args.upload:
+        accessKey = os.environ.get('AWS_ACCESS_KEY_ID', None)
+        secretKey = os.environ.get('AWS_SECRET_ACCESS_KEY', None)
+        if not accessKey or not secretKey:
+            parser.error(
+                'uploading requires AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY in the environment')
+        record = os.path.join(base, WAG_DIR, UPLOAD_RECORD_FILE.format(
+            hashlib.md5(args.upload.encode('utf-8')).hexdigest()))
+        sink = UploadSink(args.upload, accessKey, secretKey,
+                          args.upload_region, record, args.upload_jobs)
+    generator = MetaGenerator(hashContents=args.hash, imageCacheSize=args.image_cache, jobs=args.jobs,
+                              store=args.store or None, useStore=args.store is not None, pack=args.pack,
+                              maxMemory=args.max_memory, measureStages=args.stats is not None, previewSizes=args.previews,
+                              formats=args.formats, quality=args.quality, jpegSubsampling=args.jpeg_subsampling,
+                              jpegProgressive=args.jpeg_progressive, sprites=args.sprites, sink=sink,
+                              backend=args.backend)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    if args.trace_memory:
+        tracemalloc.start()
+    start = time.time()
+    wall = time.perf_counter()
+    counters = generator.process(base, args.full, args.compact)
+    if sink is not None:
+        sink.uploadMissing(base)
+        counters.update(sink.flush())
+    wall = time.perf_counter() - wall
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    printCounters(counters)
+    if sink is not None:
+        print('Uploads:', counters['uploads'])
+        print('Bytes uploaded:', counters['uploadBytes'])
+        print('Uploads skipped:', counters['uploadSkips'])
+        print('Upload retries:', counters['uploadRetries'])
+        print('Upload failures:', counters['uploadFailures'])
+    # in kB; the peak of the children is the largest resident set of a single worker process
+    # or of an ffmpeg process reading a video, so it is only told with worker processes
+    peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('Peak memory (kB):', peakMemory)
+    peakWorkerMemory = None
+    if generator.jobs > 1:
+        peakWorkerMemory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print('Peak memory of a worker process (kB):', peakWorkerMemory)
+    if args.stats is not None:
+        report = {'stages': getStageReport(counters), 'wall': wall,
+                  'peakMemory': peakMemory, 'peakWorkerMemory': peakWorkerMemory}
+        if args.trace_memory:
+            report['memory'] = getMemoryReport()
+        if args.stats_file:
+            with open(args.stats_file, 'w', encoding='utf-8') as f:
+                printStats(report, args.stats, f)
+        else:
+            printStats(report, args.stats, sys.stderr)
+    if args.trace_memory:
+        tracemalloc.stop()
+    if args.gc or args.gc_dry_run:
+        counters = collectGarbage(
+            base, generator.getManifest(base), start, args.gc_dry_run, generator.getStore(base))
+        print('Orphaned entries:', counters['orphans'])
+        print('Orphaned store entries:', counters['storeOrphans'])
+        print('Temporary files:', counters['tmpFiles'])
+        print('Previous thumbnail archives:', counters['packs'])
+        print('Orphaned bytes:', counters['orphanBytes'])
+    if args.watch:
+        try:
+            generator.watch(base)
+        except KeyboardInterrupt:
+            pass
+    if sink is not None:
+        sink.close()
+
+
+def printCounters(counters):
+    print('Total items:', counters['items'])
+    print('Thumbnails generated:', counters['thumbnails'])
+    print('Items skipped:', counters['skipped'])
+    print('Metadata cache hits:', counters['metaHits'])
+    print('Metadata cache misses:', counters['metaMisses'])
+    print('Image cache hits:', counters['imageHits'])
+    print('Image cache misses:', counters['imageMisses'])
+    print('Thumbnail store hits:', counters['storeHits'])
+    print('Thumbnail store misses:', counters['storeMisses'])
+    print('Bytes written:', counters['bytesWritten'])
+    print('Bytes skipped:', counters['bytesSkipped'])
+
+
+def watchAlbums(inotify, items, previousWatches, mask):
+    # inotify watches single folders, so every album is watched; adding a watch again
+    # returns the same descriptor and a moved folder keeps it
+    watches = {}
+
+    def visit(album):
+        try:
+            watches[inotify.add_watch(album[PATH], mask)] = album[PATH]
+        except OSError:
+            # removed meanwhile, the next events will tell
+            return
+        for subalbum in album[ALBUM]:
+            visit(subalbum)
+
+    visit(items)
+    for wd in previousWatches.keys() - watches.keys():
+        try:
+            inotify.rm_watch(wd)
+        except OSError:
+            pass
+    return watches
+
+
+def getChangedFolders(events, watches, base):
+    folders = set()
+    for event in events:
+        if event.mask & inotify_simple.flags.Q_OVERFLOW:
+            folders.add(base)
+            continue
+        folder = watches.get(event.wd, None)
+        if folder is None or event.name == WAG_DIR:
+            continue
+        if event.mask & inotify_simple.flags.ISDIR or isimage(event.name) or isvideo(event.name):
+            folders.add(folder)
+    return folders
+
+
+def getAlbumPaths(album):
+    paths = {album[PATH]}
+    for subalbum in album[ALBUM]:
+        paths.update(getAlbumPaths(subalbum))
+    return paths
+
+
+def rescanAlbums(album, folders):
+    if album[PATH] in folders:
+        return scanAlbum(album[PATH])
+    album[ALBUM] = [rescanAlbums(subalbum, folders)
+                    for subalbum in album[ALBUM]]
+    return album
+
+
+def getChangedAlbums(album, folders):
+    # the rescanned folders with their subtrees, and their ancestors
+    if album[PATH] in folders:
+        return getAlbumPaths(album)
+    changed = set()
+    for subalbum in album[ALBUM]:
+        changed.update(getChangedAlbums(subalbum, folders))
+    if changed:
+        changed.add(album[PATH])
+    return changed
 
 
 if __name__ == '__main__':
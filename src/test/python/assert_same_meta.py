@@ -8,11 +8,16 @@ import numpy
 
 METADATA_FILE = 'meta.json'
 THUMBNAIL_FILE = 'tn.jpg'
+LISTING_FILE = 'listing.json'
+# the modification times of the folders depend on the checkout
+LISTING_MTIME = 'mtimeNs'
+# bookkeeping of the generator which is not part of the metadata
+IGNORED_FILES = {'manifest.json', 'store'}
 
 
 def assertRecursive(expectedPath, actualPath):
-    expected = os.listdir(expectedPath)
-    actual = os.listdir(actualPath)
+    expected = [x for x in os.listdir(expectedPath) if x not in IGNORED_FILES]
+    actual = [x for x in os.listdir(actualPath) if x not in IGNORED_FILES]
     assert actual == expected, 'Dissimilar folders: ' + \
         expectedPath + ' and ' + actualPath
     for item in expected:
@@ -24,6 +29,8 @@ def assertRecursive(expectedPath, actualPath):
                 assertMeta(path, os.path.join(actualPath, item))
             elif item == THUMBNAIL_FILE:
                 assertThumbnail(path, os.path.join(actualPath, item))
+            elif item == LISTING_FILE:
+                assertListing(path, os.path.join(actualPath, item))
             else:
                 assert False, 'Unexpected file: ' + path
 
@@ -39,6 +46,17 @@ def assertMeta(expectedMeta, actualMeta):
         expectedMeta + ' and ' + actualMeta
 
 
+def assertListing(expectedListing, actualListing):
+    with open(expectedListing, encoding='utf-8') as f:
+        expected = json.load(f)
+    with open(actualListing, encoding='utf-8') as f:
+        actual = json.load(f)
+    expected.pop(LISTING_MTIME, None)
+    actual.pop(LISTING_MTIME, None)
+    assert actual == expected, 'Dissimilar listings: ' + \
+        expectedListing + ' and ' + actualListing
+
+
 def assertThumbnail(expectedThumbnail, actualThumbnail):
     expectedImage = imageio.imread(expectedThumbnail)
     actualImage = imageio.imread(actualThumbnail)
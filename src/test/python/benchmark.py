@@ -0,0 +1,362 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import imageio
+import numpy
+from PIL import Image as PILImage
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', '..', 'main', 'python'))
+import wagmetagen  # noqa: E402
+
+
+def findFiles(folder, accept):
+    files = []
+    for root, dirs, names in os.walk(folder):
+        dirs[:] = sorted(filter(lambda x: x != wagmetagen.WAG_DIR, dirs))
+        for name in sorted(names):
+            if accept(name):
+                files.append(os.path.join(root, name))
+    return files
+
+
+def timeCall(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def decodeImageMeta(path, stat):
+    # the metadata extraction before header-only parsing: decode the pixels to learn the size
+    image = imageio.imread(path)
+    return wagmetagen.parseImageMeta(path, image.shape[1], image.shape[0], image.meta.get('EXIF_MAIN', None), stat)
+
+
+def benchmarkMeta(folder, repeat):
+    totalDecode = 0
+    totalHeader = 0
+    files = findFiles(folder, wagmetagen.isimage)
+    for path in files:
+        stat = os.stat(path)
+        decodeTime, decodeMeta = timeCall(
+            lambda: decodeImageMeta(path, stat), repeat)
+        headerTime, headerMeta = timeCall(
+            lambda: wagmetagen.extractImageMeta(path, stat), repeat)
+        assert decodeMeta == headerMeta, 'Dissimilar metadata: ' + path
+        totalDecode += decodeTime
+        totalHeader += headerTime
+        print('{:10.2f} ms {:10.2f} ms  {}'.format(
+            decodeTime * 1000, headerTime * 1000, os.path.relpath(path, folder)))
+    print('Images:', len(files))
+    print('Decode + extract: {:.3f} s'.format(totalDecode))
+    print('Header-only extract: {:.3f} s'.format(totalHeader))
+    if totalHeader > 0:
+        print('Speedup: {:.1f}x'.format(totalDecode / totalHeader))
+    return {'images': len(files), 'decode': totalDecode, 'header': totalHeader}
+
+
+def thumbnailError(expected, actual):
+    err = numpy.sum((expected.astype('float') - actual.astype('float')) ** 2)
+    return err / float(expected.shape[0] * expected.shape[1])
+
+
+def measureThumbnail(path, reduced, queue):
+    # runs in a fresh process, so that the peak RSS belongs to this image only
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if reduced:
+        image = wagmetagen.decodeImage(path, wagmetagen.THUMBNAIL_SIZE)
+    else:
+        image = imageio.imread(path)
+    tn = wagmetagen.makeThumbnail(image, wagmetagen.THUMBNAIL_SIZE)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, baseline, peak, tn))
+
+
+def runMeasurement(target, *args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=target, args=args + (queue,))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def benchmarkDecode(folder, repeat):
+    totals = [0, 0]
+    files = findFiles(folder, wagmetagen.isimage)
+    print('{:>10} {:>10} {:>10} {:>10} {:>8}'.format(
+        'full ms', 'full MB', 'draft ms', 'draft MB', 'error'))
+    for path in files:
+        results = []
+        for reduced in [False, True]:
+            best = None
+            for _ in range(repeat):
+                elapsed, baseline, peak, tn = runMeasurement(
+                    measureThumbnail, path, reduced)
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, peak - baseline, tn)
+            results.append(best)
+        for i, result in enumerate(results):
+            totals[i] += result[0]
+        print('{:10.2f} {:10.1f} {:10.2f} {:10.1f} {:8.1f}  {}'.format(
+            results[0][0] * 1000, results[0][1] / 1024,
+            results[1][0] * 1000, results[1][1] / 1024,
+            thumbnailError(results[0][2], results[1][2]), os.path.relpath(path, folder)))
+    print('Images:', len(files))
+    print('Full decode: {:.3f} s'.format(totals[0]))
+    print('Reduced decode: {:.3f} s'.format(totals[1]))
+    return {'images': len(files), 'full': totals[0], 'reduced': totals[1]}
+
+
+def readVideoLoop(path):
+    # the frame grabbing before seeking: decode every frame up to 2 seconds, then open the video again for the size
+    frames = imageio.get_reader(path, 'ffmpeg')
+    frameOffset = frames.get_meta_data()['fps'] * wagmetagen.VIDEO_FRAME_OFFSET
+    for i, frame in enumerate(frames):
+        lastFrame = frame
+        if i >= frameOffset:
+            break
+    frames.close()
+    frames = imageio.get_reader(path, 'ffmpeg')
+    size = frames.get_meta_data()['size']
+    frames.close()
+    return size, lastFrame
+
+
+def readVideoSeek(path):
+    stat = os.stat(path)
+    frame = wagmetagen.readFrame(path, stat)
+    return wagmetagen.getVideoProbe(path, stat)['size'], frame
+
+
+def benchmarkVideo(folder, repeat):
+    totals = [0, 0]
+    files = findFiles(folder, wagmetagen.isvideo)
+    print('{:>10} {:>10} {:>8}'.format('loop ms', 'seek ms', 'error'))
+    for path in files:
+        results = []
+        for read in [readVideoLoop, readVideoSeek]:
+            wagmetagen.defaultGenerator.clearCaches()
+            results.append(timeCall(lambda: read(path), repeat))
+        assert tuple(results[0][1][0]) == tuple(results[1][1][0]), 'Dissimilar size: ' + path
+        for i, result in enumerate(results):
+            totals[i] += result[0]
+        print('{:10.2f} {:10.2f} {:8.1f}  {}'.format(
+            results[0][0] * 1000, results[1][0] * 1000,
+            thumbnailError(wagmetagen.makeThumbnail(results[0][1][1], wagmetagen.THUMBNAIL_SIZE),
+                           wagmetagen.makeThumbnail(results[1][1][1], wagmetagen.THUMBNAIL_SIZE)),
+            os.path.relpath(path, folder)))
+    print('Videos:', len(files))
+    print('Frame loop: {:.3f} s'.format(totals[0]))
+    print('Seek and probe: {:.3f} s'.format(totals[1]))
+    return {'videos': len(files), 'loop': totals[0], 'seek': totals[1]}
+
+
+def runGenerator(folder, *args):
+    # in a separate process, like it is run for real
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, wagmetagen.__file__, folder] + list(args),
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    elapsed = time.perf_counter() - start
+    counters = {}
+    for line in output.splitlines():
+        key, value = line.rsplit(':', 1)
+        counters[key] = int(value)
+    return elapsed, counters
+
+
+def timeStage(items, stage, repeat):
+    return timeCall(lambda: [stage(item) for item in items], repeat)
+
+
+def benchmarkGallery(folder, repeat):
+    results = {}
+    results['full'], counters = timeCall(
+        lambda: runGenerator(folder, '--full'), repeat)
+    results['noop'], _ = timeCall(lambda: runGenerator(folder), repeat)
+    results['items'] = counters[1]['Total items']
+
+    images = [(path, os.stat(path))
+              for path in findFiles(folder, wagmetagen.isimage)]
+    videos = [(path, os.stat(path))
+              for path in findFiles(folder, wagmetagen.isvideo)]
+    stages = {}
+    stages['scan'], _ = timeCall(lambda: wagmetagen.scanAlbum(folder), repeat)
+    stages['meta'], _ = timeStage(
+        images, lambda image: wagmetagen.extractImageMeta(*image), repeat)
+    stages['decode'], decoded = timeStage(
+        images, lambda image: wagmetagen.decodeImage(image[0], wagmetagen.THUMBNAIL_SIZE), repeat)
+    stages['resize'], thumbnails = timeStage(
+        decoded, lambda image: wagmetagen.makeThumbnail(image, wagmetagen.THUMBNAIL_SIZE), repeat)
+    stages['encode'], _ = timeStage(thumbnails, lambda tn: imageio.imwrite(
+        imageio.RETURN_BYTES, tn, format=os.path.splitext(wagmetagen.THUMBNAIL_FILE)[1]), repeat)
+    if wagmetagen.canReadVideos:
+        stages['video'], _ = timeStage(
+            videos, lambda video: wagmetagen.readFrame(*video), repeat)
+    results['stages'] = stages
+    results['images'] = len(images)
+    results['videos'] = len(videos)
+
+    print('Items:', results['items'])
+    print('Full run: {:.3f} s'.format(results['full']))
+    print('No-op run: {:.3f} s'.format(results['noop']))
+    for stage, elapsed in stages.items():
+        print('Stage {}: {:.3f} s'.format(stage, elapsed))
+    return results
+
+
+# the encoders compared by the formats benchmark, with the generator settings selecting them
+ENCODERS = [
+    ('jpeg', wagmetagen.FORMAT_JPEG, {}),
+    ('jpeg-optimized', wagmetagen.FORMAT_JPEG, {'quality': 75}),
+    ('jpeg-progressive', wagmetagen.FORMAT_JPEG, {'jpegProgressive': True}),
+    ('jpeg-444-q85', wagmetagen.FORMAT_JPEG, {'quality': 85, 'jpegSubsampling': '4:4:4'}),
+    ('webp', wagmetagen.FORMAT_WEBP, {}),
+    ('webp-q60', wagmetagen.FORMAT_WEBP, {'quality': 60}),
+    ('avif', wagmetagen.FORMAT_AVIF, {}),
+    ('avif-q50', wagmetagen.FORMAT_AVIF, {'quality': 50}),
+]
+
+
+def benchmarkFormats(folder, repeat):
+    thumbnails = [wagmetagen.makeThumbnail(wagmetagen.decodeImage(path, wagmetagen.THUMBNAIL_SIZE), wagmetagen.THUMBNAIL_SIZE)
+                  for path in findFiles(folder, wagmetagen.isimage)]
+    results = {}
+    print('{:20} {:>10} {:>10} {:>10}'.format('encoder', 'kB', 'ms/tn', 'error'))
+    for name, fmt, settings in ENCODERS:
+        if (fmt == wagmetagen.FORMAT_WEBP and not wagmetagen.canWriteWebp) or \
+                (fmt == wagmetagen.FORMAT_AVIF and not wagmetagen.canWriteAvif):
+            continue
+        generator = wagmetagen.MetaGenerator(**settings)
+        elapsed, (encoded, _, _) = timeCall(lambda: wagmetagen.runTask(generator, lambda: [
+            wagmetagen.encodeImage(tn, fmt) for tn in thumbnails]), repeat)
+        size = sum(len(data) for data in encoded)
+        error = sum(thumbnailError(tn, numpy.asarray(PILImage.open(io.BytesIO(data)).convert('RGB')))
+                    for tn, data in zip(thumbnails, encoded)) / max(len(thumbnails), 1)
+        results[name] = {'bytes': size, 'encode': elapsed, 'error': error}
+        print('{:20} {:10.1f} {:10.3f} {:10.1f}'.format(
+            name, size / 1024, elapsed * 1000 / max(len(thumbnails), 1), error))
+    print('Thumbnails:', len(thumbnails))
+    return results
+
+
+def benchmarkBackends(folder, repeat):
+    # decoding and scaling down to a thumbnail and from that to a pinkynail, the error is against the default backend
+    files = findFiles(folder, wagmetagen.isimage)
+    expected = {}
+    results = {}
+    print('{:10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'backend', 'tn ms', 'images/s', 'tn error', 'pn ms', 'pn error'))
+    for name in [wagmetagen.BACKEND_DEFAULT] + sorted(wagmetagen.BACKENDS.keys() - {wagmetagen.BACKEND_DEFAULT}):
+        generator = wagmetagen.MetaGenerator(backend=name)
+        backend = generator.backend
+        totals = {'thumbnail': 0, 'pinkynail': 0, 'thumbnailError': 0, 'pinkynailError': 0}
+        for path in files:
+            elapsed, (tn, _, _) = timeCall(lambda: wagmetagen.runTask(generator, lambda: backend.thumbnail(
+                backend.decode(path, wagmetagen.THUMBNAIL_SIZE), wagmetagen.THUMBNAIL_SIZE)), repeat)
+            totals['thumbnail'] += elapsed
+            elapsed, pinkynail = timeCall(lambda: backend.thumbnail(tn, wagmetagen.PINKYNAIL_SIZE), repeat)
+            totals['pinkynail'] += elapsed
+            expectedTn, expectedPinkynail = expected.setdefault(path, (tn, pinkynail))
+            totals['thumbnailError'] += thumbnailError(expectedTn, tn) / len(files)
+            totals['pinkynailError'] += thumbnailError(expectedPinkynail, pinkynail) / len(files)
+        results[name] = totals
+        print('{:10} {:10.2f} {:10.1f} {:10.1f} {:10.3f} {:10.1f}'.format(
+            name, totals['thumbnail'] * 1000 / max(len(files), 1),
+            len(files) / totals['thumbnail'] if totals['thumbnail'] > 0 else 0, totals['thumbnailError'],
+            totals['pinkynail'] * 1000 / max(len(files), 1), totals['pinkynailError']))
+    print('Images:', len(files))
+    return results
+
+
+def flattenResults(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flattenResults(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compareResults(baseline, results):
+    previous = flattenResults(baseline)
+    for key, value in flattenResults(results).items():
+        if key in previous and isinstance(value, float) and previous[key] > 0:
+            print('{:20} {:10.3f} {:10.3f} {:8.2f}x'.format(
+                key, previous[key], value, previous[key] / value if value > 0 else float('inf')))
+
+
+def getCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+BENCHMARKS = {
+    'backends': benchmarkBackends,
+    'decode': benchmarkDecode,
+    'formats': benchmarkFormats,
+    'gallery': benchmarkGallery,
+    'meta': benchmarkMeta,
+    'video': benchmarkVideo,
+}
+
+
+def main(argv=None):
+    if argv is None:
+        ourArgv = sys.argv[1:]
+    else:
+        ourArgv = argv
+    parser = argparse.ArgumentParser(
+        description='Benchmarks stages of the WebAlbumGenarator metadata generator')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()),
+                        help='benchmark to run')
+    parser.add_argument('folder',
+                        help='folder with media to benchmark')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of repetitions, the best time is reported (default: %(default)s)')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the results as JSON, to compare them between commits')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare the timings with results written by --output')
+    args = parser.parse_args(ourArgv)
+    results = BENCHMARKS[args.benchmark](args.folder, args.repeat)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print('{:20} {:>10} {:>10} {:>9}'.format(
+            'baseline ' + str(baseline['commit'])[:8], 'before s', 'after s', 'speedup'))
+        compareResults(baseline['results'], results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'benchmark': args.benchmark,
+                'folder': os.path.abspath(args.folder),
+                'commit': getCommit(),
+                'python': platform.python_version(),
+                'repeat': args.repeat,
+                'results': results,
+            }, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import argparse
+import logging
+import os
+import struct
+import subprocess
+import sys
+
+import imageio_ffmpeg
+import iptcinfo3
+import numpy
+from PIL import Image
+
+logging.getLogger('iptcinfo').disabled = True
+
+EXIF_IMAGE_DESCRIPTION = 0x010E
+EXIF_ORIENTATION = 0x0112
+EXIF_ARTIST = 0x013B
+EXIF_COPYRIGHT = 0x8298
+EXIF_DATE_TIME_ORIGINAL = 0x9003
+FORMATS = {
+    'jpeg': '.jpg',
+    'png': '.png',
+    'gif': '.gif',
+}
+
+
+def parseResolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def makeExif(entries):
+    # a single TIFF directory with ASCII and SHORT entries, values longer than 4 bytes follow it
+    entries = sorted(entries.items())
+    dataOffset = 8 + 2 + 12 * len(entries) + 4
+    directory = struct.pack('<H', len(entries))
+    data = b''
+    for tag, value in entries:
+        if isinstance(value, int):
+            directory += struct.pack('<HHIHH', tag, 3, 1, value, 0)
+            continue
+        raw = value.encode('ascii') + b'\x00'
+        if len(raw) <= 4:
+            directory += struct.pack('<HHI', tag, 2, len(raw)) + raw.ljust(4, b'\x00')
+        else:
+            directory += struct.pack('<HHII', tag, 2,
+                                     len(raw), dataOffset + len(data))
+            data += raw + b'\x00' * (len(raw) % 2)
+    return b'Exif\x00\x00II*\x00' + struct.pack('<I', 8) + directory + struct.pack('<I', 0) + data
+
+
+def makePixels(random, width, height, alpha=False):
+    # smooth content compresses like photos, unlike noise
+    channels = 4 if alpha else 3
+    small = random.randint(0, 256, (max(height // 100, 2), max(
+        width // 100, 2), channels)).astype(numpy.uint8)
+    return Image.fromarray(small).resize((width, height), Image.BICUBIC)
+
+
+def makeImage(path, fmt, resolution, random, index):
+    width, height = resolution
+    if fmt == 'jpeg':
+        image = makePixels(random, width, height)
+        exif = {
+            EXIF_DATE_TIME_ORIGINAL: '2020:{:02d}:{:02d} 12:00:00'.format(index % 12 + 1, index % 28 + 1),
+            EXIF_ARTIST: 'Artist {}'.format(index),
+            EXIF_ORIENTATION: [1, 6, 3, 8][index % 4],
+        }
+        if index % 3 == 0:
+            exif[EXIF_IMAGE_DESCRIPTION] = 'Description {}'.format(index)
+        if index % 5 == 0:
+            exif[EXIF_COPYRIGHT] = 'Copyright {}'.format(index)
+        image.save(path, quality=90, exif=makeExif(exif))
+        if index % 2 == 0:
+            iptc = iptcinfo3.IPTCInfo(path, force=True)
+            iptc['caption/abstract'] = 'Caption {}'.format(index)
+            iptc['copyright notice'] = 'Copyright {}'.format(index)
+            iptc.save()
+            if os.path.exists(path + '~'):
+                os.remove(path + '~')
+    elif fmt == 'png':
+        makePixels(random, width, height, True).save(path)
+    else:
+        makePixels(random, width, height).convert('P').save(path)
+
+
+def makeVideo(path, resolution, duration, index):
+    subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'lavfi',
+                    '-i', 'testsrc2=size={}x{}:rate=30:duration={}'.format(
+                        resolution[0], resolution[1], duration),
+                    '-vf', 'hue=h={}'.format(index * 37 % 360), '-pix_fmt', 'yuv420p', '-preset', 'ultrafast', path], check=True)
+
+
+def makeAlbum(folder, depth, options, random, counters):
+    os.makedirs(folder, exist_ok=True)
+    for i in range(options.images):
+        fmt = options.formats[counters['images'] % len(options.formats)]
+        resolution = options.resolutions[counters['images'] % len(
+            options.resolutions)]
+        makeImage(os.path.join(folder, 'image-{:04d}{}'.format(i, FORMATS[fmt])),
+                  fmt, resolution, random, counters['images'])
+        counters['images'] += 1
+    for i in range(options.videos):
+        makeVideo(os.path.join(folder, 'video-{:04d}.mp4'.format(i)),
+                  options.video_resolution, options.video_duration, counters['videos'])
+        counters['videos'] += 1
+    for i in range(options.groups):
+        # a video with a poster image of the same name
+        name = os.path.join(folder, 'clip-{:04d}'.format(i))
+        makeVideo(name + '.mp4', options.video_resolution,
+                  options.video_duration, counters['videos'])
+        makeImage(name + '.jpg', 'jpeg', options.video_resolution,
+                  random, counters['images'])
+        counters['videos'] += 1
+        counters['images'] += 1
+    counters['albums'] += 1
+    if depth > 0:
+        for i in range(options.fanout):
+            makeAlbum(os.path.join(folder, 'album-{:02d}'.format(i)),
+                      depth - 1, options, random, counters)
+
+
+def makeGallery(folder, options):
+    counters = {'albums': 0, 'images': 0, 'videos': 0}
+    makeAlbum(folder, options.depth, options,
+              numpy.random.RandomState(options.seed), counters)
+    return counters
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description='Creates a synthetic gallery for benchmarking the metadata generator')
+    parser.add_argument('folder',
+                        help='folder to create the gallery in')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='levels of subalbums below the root album (default: %(default)s)')
+    parser.add_argument('--fanout', type=int, default=3,
+                        help='subalbums in every album above the deepest level (default: %(default)s)')
+    parser.add_argument('--images', type=int, default=10,
+                        help='images in every album (default: %(default)s)')
+    parser.add_argument('--resolutions', type=lambda x: [parseResolution(r) for r in x.split(',')],
+                        default=[(4000, 3000), (1920, 1080)], metavar='WxH[,WxH...]',
+                        help='image resolutions, used in turn (default: 4000x3000,1920x1080)')
+    parser.add_argument('--formats', type=lambda x: x.split(','), default=['jpeg'], metavar='FORMAT[,FORMAT...]',
+                        help='image formats, used in turn: ' + ', '.join(sorted(FORMATS.keys())) + ' (default: jpeg)')
+    parser.add_argument('--videos', type=int, default=0,
+                        help='videos without a poster image in every album (default: %(default)s)')
+    parser.add_argument('--groups', type=int, default=0,
+                        help='videos with a poster image in every album (default: %(default)s)')
+    parser.add_argument('--video-resolution', type=parseResolution, default=(1280, 720), metavar='WxH',
+                        help='resolution of the videos (default: 1280x720)')
+    parser.add_argument('--video-duration', type=float, default=5,
+                        help='length of the videos in seconds (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random image content (default: %(default)s)')
+    args = parser.parse_args(argv)
+    for fmt in args.formats:
+        if fmt not in FORMATS:
+            parser.error('unknown format: ' + fmt)
+    return args
+
+
+def main(argv=None):
+    if argv is None:
+        ourArgv = sys.argv[1:]
+    else:
+        ourArgv = argv
+    args = parseArgs(ourArgv)
+    counters = makeGallery(args.folder, args)
+    print('Albums:', counters['albums'])
+    print('Images:', counters['images'])
+    print('Videos:', counters['videos'])
+
+
+if __name__ == '__main__':
+    main()
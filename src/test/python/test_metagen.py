@@ -0,0 +1,690 @@
+import argparse
+import contextlib
+import gc
+import hashlib
+import http.server
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import warnings
+from unittest import mock
+
+import imageio
+import numpy
+from PIL import Image as PILImage
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', '..', 'main', 'python'))
+import wagmetagen  # noqa: E402
+
+# a small subset of the test data keeps the repeated runs fast
+TEST_ITEMS = ['image.jpg', 'exif', 'VideoGrouping', '2-subalbums']
+
+dataFolder = None
+
+
+def run(folder, *args):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        wagmetagen.main([folder] + list(args))
+    stats = {}
+    for line in output.getvalue().splitlines():
+        key, value = line.rsplit(':', 1)
+        stats[key] = int(value)
+    return stats
+
+
+def snapshot(folder):
+    files = {}
+    for root, _, names in os.walk(os.path.join(folder, '.wag')):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, folder)] = f.read()
+    return files
+
+
+def withoutManifest(files):
+    # also without the listings, which have the modification times of the folders
+    return {path: data for path, data in files.items()
+            if os.path.basename(path) not in [wagmetagen.MANIFEST_FILE, wagmetagen.LISTING_FILE] and
+            wagmetagen.STORE_DIR not in path}
+
+
+def readThumbnail(path, folder):
+    with open(os.path.join(wagmetagen.getMetaDir(path, folder), wagmetagen.THUMBNAIL_FILE), 'rb') as f:
+        return f.read()
+
+
+def readManifestEntry(path, folder):
+    with open(os.path.join(folder, wagmetagen.WAG_DIR, wagmetagen.MANIFEST_FILE), encoding='utf-8') as f:
+        return json.load(f)[wagmetagen.MANIFEST_ENTRIES][wagmetagen.getManifestKey(path, folder)]
+
+
+def readPackedThumbnails(folder):
+    files = {}
+    pack = wagmetagen.readPack(folder)
+    with open(wagmetagen.getPackPath(folder, pack[wagmetagen.PACK_GENERATION]), 'rb') as f:
+        for metaId, (offset, length) in pack[wagmetagen.PACK_ENTRIES].items():
+            f.seek(offset)
+            files[os.path.join(wagmetagen.WAG_DIR, metaId, wagmetagen.THUMBNAIL_FILE)] = f.read(length)
+    return files
+
+
+def backdateFolders(folder):
+    past = time.time() - 10
+    for root, names, _ in os.walk(folder):
+        names[:] = [name for name in names if name != wagmetagen.WAG_DIR]
+        os.utime(root, (past, past))
+
+
+def waitForAlbumItem(album, path, folder, present):
+    # the watch may not be set up yet, so the change is repeated until it is noticed
+    for _ in range(20):
+        try:
+            with open(os.path.join(wagmetagen.getMetaDir(album, folder), wagmetagen.METADATA_FILE), encoding='utf-8') as f:
+                items = json.load(f)['items']
+            if (wagmetagen.getMetaId(path, folder) in items) == present:
+                return True
+        except ValueError:
+            # being written
+            pass
+        if os.path.exists(path):
+            os.utime(path)
+        time.sleep(0.5)
+    return False
+
+
+class ObjectHandler(http.server.BaseHTTPRequestHandler):
+    # a stand-in for an S3 compatible storage, failing some requests once
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failing = self.path in server.failing
+            server.failing.discard(self.path)
+            if not failing and self.headers['Authorization'].startswith('AWS4-HMAC-SHA256 Credential=key/'):
+                server.objects[self.path] = data
+        self.send_response(500 if failing else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class GalleryTestCase(unittest.TestCase):
+    # every test runs on its own copy of the test items, generated once
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        # the name of the root folder is the caption of the root album
+        self.folder = os.path.join(self.tmpDir, 'test')
+        os.makedirs(self.folder)
+        for item in TEST_ITEMS:
+            src = os.path.join(dataFolder, item)
+            if os.path.isdir(src):
+                shutil.copytree(src, os.path.join(self.folder, item))
+            else:
+                shutil.copy2(src, self.folder)
+        # the listings keep the modification times of folders only once they are in the past
+        backdateFolders(self.folder)
+        run(self.folder, '--full')
+        # creating the .wag folder updates the root album
+        backdateFolders(self.folder)
+        run(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+
+class TestIncremental(GalleryTestCase):
+    def test_noop(self):
+        before = snapshot(self.folder)
+        stats = run(self.folder)
+        self.assertEqual(stats['Thumbnails generated'], 0)
+        self.assertEqual(stats['Items skipped'], stats['Total items'])
+        self.assertEqual(stats['Bytes written'], 0)
+        self.assertEqual(snapshot(self.folder), before)
+
+    def test_full(self):
+        metaPath = os.path.join(wagmetagen.getMetaDir(
+            os.path.join(self.folder, 'image.jpg'), self.folder), wagmetagen.METADATA_FILE)
+        mtime = os.stat(metaPath).st_mtime_ns
+        stats = run(self.folder, '--full')
+        self.assertEqual(stats['Items skipped'], 0)
+        # the regenerated files are the same and are not written again
+        self.assertEqual(stats['Bytes written'], 0)
+        self.assertGreater(stats['Bytes skipped'], 0)
+        self.assertEqual(os.stat(metaPath).st_mtime_ns, mtime)
+
+    def test_jobs(self):
+        before = snapshot(self.folder)
+        stats = run(self.folder, '--full', '--jobs', '4')
+        self.assertEqual(stats['Items skipped'], 0)
+        self.assertEqual(snapshot(self.folder), before)
+
+    def test_modified(self):
+        image = os.path.join(self.folder, 'exif', '1-no-meta.jpg')
+        os.utime(image)
+        stats = run(self.folder)
+        # the image, its album and the root album
+        self.assertEqual(stats['Thumbnails generated'], 3)
+        stat = os.stat(image)
+        self.assertEqual(readManifestEntry(image, self.folder), [stat.st_mtime_ns, stat.st_size, stat.st_ino])
+
+    def test_missing_output(self):
+        metaDir = wagmetagen.getMetaDir(
+            os.path.join(self.folder, 'image.jpg'), self.folder)
+        os.remove(os.path.join(metaDir, wagmetagen.METADATA_FILE))
+        stats = run(self.folder)
+        self.assertEqual(stats['Thumbnails generated'], 1)
+        self.assertTrue(os.path.isfile(
+            os.path.join(metaDir, wagmetagen.METADATA_FILE)))
+
+    def test_process_items(self):
+        generator = wagmetagen.MetaGenerator()
+        generator.process(self.folder)
+        image = os.path.join(self.folder, 'exif', 'added.jpg')
+        shutil.copy2(os.path.join(self.folder, 'exif', '1-no-meta.jpg'), image)
+        counters = generator.processItems(self.folder, [image])
+        # the image, its album and the root album
+        self.assertEqual(counters['thumbnails'], 3)
+        self.assertTrue(os.path.isfile(os.path.join(wagmetagen.getMetaDir(
+            image, self.folder), wagmetagen.METADATA_FILE)))
+        self.assertEqual(generator.stats['thumbnails'], 3)
+        # the signatures of the other albums are taken over from the previous run
+        self.assertEqual(generator.getManifest(self.folder)[wagmetagen.MANIFEST_ENTRIES],
+                         wagmetagen.collectSignatures(wagmetagen.scanAlbum(self.folder), self.folder, False))
+        # the metadata of changed and removed items is not kept
+        self.assertIn(image, {key[0] for key in generator.metaCache})
+        os.utime(image, (0, 0))
+        generator.processItems(self.folder, [image])
+        self.assertEqual(len([key for key in generator.metaCache if key[0] == image]), 1)
+        os.remove(image)
+        generator.processItems(self.folder, [image])
+        self.assertNotIn(image, {key[0] for key in generator.metaCache})
+
+    def test_threads(self):
+        before = snapshot(self.folder)
+        other = os.path.join(self.tmpDir, 'other', 'test')
+        shutil.copytree(self.folder, other, ignore=shutil.ignore_patterns(wagmetagen.WAG_DIR))
+        generator = wagmetagen.MetaGenerator()
+        threads = [threading.Thread(target=generator.process, args=(folder, True))
+                   for folder in [self.folder, other]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(snapshot(self.folder), before)
+        # the manifests differ in the inodes and the listings in the times of the folders
+        self.assertEqual(withoutManifest(snapshot(other)), withoutManifest(before))
+
+
+class TestListing(GalleryTestCase):
+    def test_listing(self):
+        album = os.path.join(self.folder, '2-subalbums')
+        protected = sorted(os.listdir(album))[0]
+        with open(os.path.join(album, protected, wagmetagen.PASSWORD_FILE), 'w') as f:
+            f.write('secret')
+        os.makedirs(os.path.join(album, 'empty'))
+        with open(os.path.join(album, 'notes.txt'), 'w') as f:
+            f.write('not a medium')
+        mtime = os.stat(album).st_mtime_ns - 10 ** 10
+        os.utime(album, ns=(mtime, mtime))
+        run(self.folder)
+        with open(os.path.join(wagmetagen.getMetaDir(album, self.folder), wagmetagen.LISTING_FILE), encoding='utf-8') as f:
+            listing = json.load(f)
+        # what wag.php would list itself
+        expected = []
+        for name in sorted(os.listdir(album)):
+            path = os.path.join(album, name)
+            if os.path.isfile(path) and (wagmetagen.isimage(name) or wagmetagen.isvideo(name)):
+                expected.append({'type': 'medium', 'path': '2-subalbums/' + name})
+            elif os.path.isdir(path):
+                expected.append({'type': 'album', 'path': '2-subalbums/' + name})
+        # protected albums are left out by wag.php, so that removing the password shows them at once
+        self.assertEqual(listing[wagmetagen.LISTING_ENTRIES], expected)
+        self.assertIn('2-subalbums/' + protected, [entry['path'] for entry in expected])
+        self.assertEqual(listing[wagmetagen.LISTING_MTIME], mtime)
+        # a change within the second of the scan would not show in the time wag.php compares,
+        # nor would one while the clock of the file server is ahead
+        mtime = time.time() + 10
+        os.utime(album, (mtime, mtime))
+        run(self.folder)
+        with open(os.path.join(wagmetagen.getMetaDir(album, self.folder), wagmetagen.LISTING_FILE), encoding='utf-8') as f:
+            self.assertIsNone(json.load(f)[wagmetagen.LISTING_MTIME])
+
+
+class TestMemory(GalleryTestCase):
+    def test_max_memory(self):
+        before = snapshot(self.folder)
+        # a budget too small for any item: one item at a time, and images other than JPEG decoded in tiles
+        stats = run(self.folder, '--full', '--jobs', '2', '--max-memory', '1')
+        self.assertEqual(stats['Items skipped'], 0)
+        self.assertGreater(stats['Peak memory (kB)'], 0)
+        self.assertGreater(stats['Peak memory of a worker process (kB)'], 0)
+        after = snapshot(self.folder)
+        self.assertEqual(after.keys(), before.keys())
+        for path, data in after.items():
+            if os.path.basename(path) == wagmetagen.METADATA_FILE:
+                self.assertEqual(data, before[path])
+            elif os.path.basename(path) == wagmetagen.THUMBNAIL_FILE:
+                # reduced in tiles, the thumbnails differ in the fine detail only
+                thumbnail = imageio.imread(data, format='jpg')
+                expected = imageio.imread(before[path], format='jpg')
+                self.assertEqual(thumbnail.shape, expected.shape)
+                self.assertLess(numpy.mean((thumbnail.astype('float') - expected) ** 2), 100)
+        # the thumbnails decoded in tiles are neither kept nor taken from the store without the budget
+        self.assertEqual(run(self.folder, '--store')['Items skipped'], 0)
+        stats = run(self.folder, '--store', '--max-memory', '1')
+        self.assertEqual(stats['Items skipped'], 0)
+        self.assertEqual(stats['Thumbnail store hits'], 0)
+
+    def test_preview_footprint(self):
+        image = os.path.join(dataFolder, 'sources', 'Nikon-D7000.JPG')
+        footprints = [wagmetagen.MetaGenerator(jobs=2, maxMemory=1024, previewSizes=sizes).getFootprint([image], True)
+                      for sizes in [(), (800,), (400, 800), (400, 800, 4000)]]
+        # decoded at the largest preview size below the image size, with the previews besides
+        self.assertLess(footprints[0], footprints[1])
+        self.assertEqual(footprints[2] - footprints[1], 400 * 265 * wagmetagen.PREVIEW_BYTES_PER_PIXEL)
+        self.assertEqual(footprints[3], footprints[2])
+
+
+class TestStore(GalleryTestCase):
+    def test_moved(self):
+        run(self.folder, '--full', '--store')
+        images = sorted(os.listdir(os.path.join(self.folder, 'exif')))
+        thumbnails = [readThumbnail(os.path.join(self.folder, 'exif', image), self.folder)
+                      for image in images]
+        os.rename(os.path.join(self.folder, 'exif'),
+                  os.path.join(self.folder, 'moved'))
+        stats = run(self.folder, '--store')
+        self.assertEqual(stats['Thumbnail store hits'], len(images))
+        self.assertEqual(stats['Thumbnail store misses'], 0)
+        self.assertEqual([readThumbnail(os.path.join(self.folder, 'moved', image), self.folder)
+                          for image in images], thumbnails)
+        # linked from the store rather than copied
+        for image in images:
+            tnPath = os.path.join(wagmetagen.getMetaDir(os.path.join(self.folder, 'moved', image), self.folder),
+                                  wagmetagen.THUMBNAIL_FILE)
+            self.assertGreater(os.stat(tnPath).st_nlink, 1)
+
+    def test_hashed_store(self):
+        image = os.path.join(self.folder, 'exif', '1-no-meta.jpg')
+        statsPath = os.path.join(self.tmpDir, 'stats.json')
+        for args in [[], ['--jobs', '2']]:
+            calls = []
+            for store in [[], ['--store']]:
+                run(self.folder, '--hash', *store)
+                os.utime(image)
+                run(self.folder, '--hash', '--stats', 'json', '--stats-file', statsPath, *args, *store)
+                with open(statsPath, encoding='utf-8') as f:
+                    calls.append(json.load(f)['stages'][wagmetagen.STAGE_HASH]['calls'])
+            # the store key of the changed image is the hash of its signature
+            self.assertEqual(calls[1], calls[0])
+            with open(image, 'rb') as f:
+                self.assertEqual(readManifestEntry(image, self.folder)[3], hashlib.md5(f.read()).hexdigest())
+
+
+class TestGarbageCollection(GalleryTestCase):
+    def test_gc(self):
+        run(self.folder, '--full', '--store')
+        os.rename(os.path.join(self.folder, 'exif'),
+                  os.path.join(self.folder, 'moved'))
+        # the listing does not change once the folder is older than a second
+        mtime = time.time() - 10
+        os.utime(self.folder, (mtime, mtime))
+        run(self.folder, '--store')
+        before = snapshot(self.folder)
+        # the images and the album itself
+        orphans = len(os.listdir(os.path.join(self.folder, 'moved'))) + 1
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            wagmetagen.main([self.folder, '--gc-dry-run', '--store'])
+        lines = output.getvalue().splitlines()
+        self.assertIn('Orphaned entries: ' + str(orphans), lines)
+        self.assertEqual(len([line for line in lines if line.startswith(
+            wagmetagen.WAG_DIR + os.sep)]), orphans)
+        self.assertEqual(snapshot(self.folder), before)
+
+        stats = run(self.folder, '--gc', '--store')
+        self.assertEqual(stats['Orphaned entries'], orphans)
+        self.assertGreater(stats['Orphaned bytes'], 0)
+        after = snapshot(self.folder)
+        self.assertEqual(len({os.path.dirname(path) for path in before.keys() - after.keys()}), orphans)
+        self.assertTrue(all(before[path] == data for path, data in after.items()))
+
+        # and the temporary files of interrupted runs
+        tmpPath = os.path.join(wagmetagen.getMetaDir(self.folder, self.folder), 'tn.jpg.x' + wagmetagen.TMP_SUFFIX)
+        with open(tmpPath, 'wb') as f:
+            f.write(b'partial')
+        mtime = time.time() - 10
+        os.utime(tmpPath, (mtime, mtime))
+        stats = run(self.folder, '--gc', '--store')
+        self.assertEqual(stats['Orphaned entries'], 0)
+        self.assertEqual(stats['Temporary files'], 1)
+        self.assertFalse(os.path.exists(tmpPath))
+
+        # the thumbnails of the moved images are still linked from the store, which loses them
+        # once the images are removed
+        store = os.path.join(self.folder, wagmetagen.WAG_DIR, wagmetagen.STORE_DIR)
+        stored = len(list(wagmetagen.scanStore(store)))
+        shutil.rmtree(os.path.join(self.folder, 'moved'))
+        run(self.folder, '--store')
+        stats = run(self.folder, '--gc', '--store')
+        self.assertEqual(stats['Orphaned entries'], orphans)
+        self.assertGreater(stats['Orphaned store entries'], 0)
+        self.assertEqual(len(list(wagmetagen.scanStore(store))), stored - stats['Orphaned store entries'])
+
+
+class TestPack(GalleryTestCase):
+    def test_pack(self):
+        thumbnails = {path: data for path, data in snapshot(self.folder).items()
+                      if os.path.basename(path) == wagmetagen.THUMBNAIL_FILE and wagmetagen.STORE_DIR not in path}
+        stats = run(self.folder, '--pack')
+        self.assertEqual(stats['Thumbnails generated'], 0)
+        self.assertEqual(readPackedThumbnails(self.folder), thumbnails)
+        self.assertFalse(any(os.path.isfile(os.path.join(self.folder, path))
+                             for path in thumbnails))
+
+        os.utime(os.path.join(self.folder, 'exif', '1-no-meta.jpg'))
+        stats = run(self.folder, '--pack')
+        self.assertEqual(stats['Thumbnails generated'], 3)
+        self.assertEqual(readPackedThumbnails(self.folder), thumbnails)
+        pack = wagmetagen.readPack(self.folder)
+
+        run(self.folder, '--pack', '--compact')
+        self.assertEqual(readPackedThumbnails(self.folder), thumbnails)
+        # readers of the previous index can still read the previous pack until it is collected
+        previousPath = wagmetagen.getPackPath(self.folder, pack[wagmetagen.PACK_GENERATION])
+        self.assertTrue(os.path.exists(previousPath))
+        stats = run(self.folder, '--pack', '--gc')
+        self.assertEqual(stats['Previous thumbnail archives'], 1)
+        self.assertFalse(os.path.exists(previousPath))
+        self.assertEqual(readPackedThumbnails(self.folder), thumbnails)
+
+        # the bucket could not serve packed thumbnails
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            wagmetagen.main([self.folder, '--pack', '--upload', 'http://127.0.0.1:1/bucket'])
+
+        # without packing, the thumbnails are written as files again
+        stats = run(self.folder)
+        self.assertEqual(stats['Items skipped'], 0)
+
+
+class TestPreviews(GalleryTestCase):
+    def test_previews(self):
+        image = os.path.join(self.folder, 'image.jpg')
+        metaDir = wagmetagen.getMetaDir(image, self.folder)
+        stats = run(self.folder, '--previews', '100,200,100000')
+        # the changed configuration regenerates everything
+        self.assertEqual(stats['Items skipped'], 0)
+        with open(os.path.join(metaDir, wagmetagen.METADATA_FILE), encoding='utf-8') as f:
+            previews = json.load(f)[wagmetagen.META_PREVIEWS]
+        self.assertEqual([preview[wagmetagen.META_FILE] for preview in previews],
+                         [wagmetagen.PREVIEW_FILE.format(100), wagmetagen.PREVIEW_FILE.format(200)])
+        for preview in previews:
+            data = imageio.imread(os.path.join(metaDir, preview[wagmetagen.META_FILE]))
+            self.assertEqual(data.shape[0:2], (preview[wagmetagen.META_HEIGHT], preview[wagmetagen.META_WIDTH]))
+        # the sizes no longer configured are removed with the regenerated items
+        run(self.folder, '--previews', '100')
+        self.assertTrue(os.path.isfile(os.path.join(metaDir, wagmetagen.PREVIEW_FILE.format(100))))
+        self.assertFalse(os.path.exists(os.path.join(metaDir, wagmetagen.PREVIEW_FILE.format(200))))
+        run(self.folder)
+        self.assertEqual([path for path in withoutManifest(snapshot(self.folder))
+                          if os.path.basename(path).startswith('preview-')], [])
+
+    def test_animated_previews(self):
+        # animations and transparent images are served as they are
+        images = [os.path.join(self.folder, name) for name in ['GIF-animated.gif', 'PNG-transparent.png']]
+        for image in images:
+            shutil.copy2(os.path.join(dataFolder, 'sources', os.path.basename(image)), image)
+        run(self.folder, '--previews', '50')
+        for image in images:
+            metaDir = wagmetagen.getMetaDir(image, self.folder)
+            with open(os.path.join(metaDir, wagmetagen.METADATA_FILE), encoding='utf-8') as f:
+                self.assertNotIn(wagmetagen.META_PREVIEWS, json.load(f))
+            self.assertFalse(os.path.exists(os.path.join(metaDir, wagmetagen.PREVIEW_FILE.format(50))))
+        with open(os.path.join(wagmetagen.getMetaDir(os.path.join(self.folder, 'image.jpg'), self.folder),
+                               wagmetagen.METADATA_FILE), encoding='utf-8') as f:
+            self.assertIn(wagmetagen.META_PREVIEWS, json.load(f))
+
+
+@unittest.skipUnless(wagmetagen.canWriteWebp, 'Pillow cannot write WebP')
+class TestFormats(GalleryTestCase):
+    def test_formats(self):
+        image = os.path.join(self.folder, 'image.jpg')
+        webpFile = os.path.splitext(wagmetagen.THUMBNAIL_FILE)[0] + wagmetagen.FORMAT_EXT[wagmetagen.FORMAT_WEBP]
+        run(self.folder, '--full', '--store')
+        before = readThumbnail(image, self.folder)
+        run(self.folder, '--store', '--formats', wagmetagen.FORMAT_WEBP, '--jpeg-progressive')
+        for path in [image, self.folder]:
+            with PILImage.open(os.path.join(wagmetagen.getMetaDir(path, self.folder), webpFile)) as webp:
+                self.assertEqual(webp.size, (wagmetagen.THUMBNAIL_SIZE, wagmetagen.THUMBNAIL_SIZE))
+        self.assertNotEqual(readThumbnail(image, self.folder), before)
+        for path in [image, self.folder]:
+            with open(os.path.join(wagmetagen.getMetaDir(path, self.folder), wagmetagen.METADATA_FILE),
+                      encoding='utf-8') as f:
+                self.assertEqual(json.load(f)[wagmetagen.META_FORMATS], [
+                    wagmetagen.FORMAT_TYPES[wagmetagen.FORMAT_WEBP], wagmetagen.FORMAT_TYPES[wagmetagen.FORMAT_JPEG]])
+        # the thumbnails from the store and those generated again lose their other formats alike
+        os.utime(image)
+        run(self.folder, '--store')
+        self.assertEqual([path for path in withoutManifest(snapshot(self.folder)) if path.endswith(webpFile)], [])
+        with open(os.path.join(wagmetagen.getMetaDir(image, self.folder), wagmetagen.METADATA_FILE),
+                  encoding='utf-8') as f:
+            self.assertNotIn(wagmetagen.META_FORMATS, json.load(f))
+
+
+class TestSprites(GalleryTestCase):
+    def test_sprites(self):
+        album = os.path.join(self.folder, 'exif')
+        metaDir = wagmetagen.getMetaDir(album, self.folder)
+        run(self.folder, '--sprites')
+        with open(os.path.join(metaDir, wagmetagen.METADATA_FILE), encoding='utf-8') as f:
+            items = json.load(f)[wagmetagen.META_ITEMS]
+        for image in os.listdir(album):
+            sprite = items[wagmetagen.getMetaId(os.path.join(album, image), self.folder)][wagmetagen.META_SPRITE]
+            sheet = imageio.imread(os.path.join(metaDir, sprite[wagmetagen.META_FILE]))
+            tile = sheet[sprite[wagmetagen.META_Y]:(sprite[wagmetagen.META_Y] + wagmetagen.THUMBNAIL_SIZE),
+                         sprite[wagmetagen.META_X]:(sprite[wagmetagen.META_X] + wagmetagen.THUMBNAIL_SIZE)]
+            thumbnail = imageio.imread(readThumbnail(os.path.join(album, image), self.folder))
+            # the tiles are encoded again
+            self.assertLess(numpy.mean((tile.astype('float') - thumbnail) ** 2), 100)
+        # the sheets of a run with sprites do not outlive it
+        run(self.folder)
+        self.assertFalse([name for name in os.listdir(metaDir) if name.startswith('sprite-')])
+        with open(os.path.join(metaDir, wagmetagen.METADATA_FILE), encoding='utf-8') as f:
+            items = json.load(f)[wagmetagen.META_ITEMS]
+        self.assertFalse([item for item in items.values() if wagmetagen.META_SPRITE in item])
+
+
+class TestUpload(GalleryTestCase):
+    def test_upload(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ObjectHandler)
+        server.lock = threading.Lock()
+        server.requests = 0
+        server.objects = {}
+        image = os.path.join(self.folder, 'image.jpg')
+        server.failing = {'/bucket/gallery/.wag/{}/{}'.format(
+            wagmetagen.getMetaId(image, self.folder), wagmetagen.THUMBNAIL_FILE)}
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        # left by an interrupted run
+        with open(os.path.join(wagmetagen.getMetaDir(image, self.folder), 'tn.jpg.x' + wagmetagen.TMP_SUFFIX), 'wb') as f:
+            f.write(b'partial')
+        # the listing of the root album is written again once its folder is older than a second
+        mtime = time.time() - 10
+        os.utime(self.folder, (mtime, mtime))
+        try:
+            url = 'http://127.0.0.1:{}/bucket/gallery'.format(server.server_port)
+            with mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'key', 'AWS_SECRET_ACCESS_KEY': 'secret'}):
+                # the output of the earlier runs is uploaded too
+                stats = run(self.folder, '--upload', url, '--jobs', '2')
+                files = {'/bucket/gallery/' + path.replace(os.sep, '/'): data
+                         for path, data in snapshot(self.folder).items()
+                         if wagmetagen.isMetaId(path.split(os.sep)[1]) and not path.endswith(wagmetagen.TMP_SUFFIX)}
+                self.assertEqual(server.objects, files)
+                self.assertEqual(stats['Uploads'], len(files))
+                self.assertEqual(stats['Upload retries'], 1)
+                self.assertEqual(stats['Upload failures'], 0)
+                requests = server.requests
+                stats = run(self.folder, '--upload', url, '--full')
+                self.assertEqual(stats['Uploads'], 0)
+                self.assertGreater(stats['Uploads skipped'], 0)
+                self.assertEqual(server.requests, requests)
+                os.utime(os.path.join(self.folder, 'exif', '1-no-meta.jpg'))
+                stats = run(self.folder, '--upload', url)
+                # the listings and metadata of the changed albums
+                self.assertGreater(stats['Uploads'], 0)
+                self.assertEqual(server.objects['/bucket/gallery/.wag/{}/{}'.format(
+                    wagmetagen.getMetaId(self.folder, self.folder), wagmetagen.METADATA_FILE)],
+                    snapshot(self.folder)[os.path.join('.wag', wagmetagen.getMetaId(self.folder, self.folder),
+                                                       wagmetagen.METADATA_FILE)])
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+class TestBackends(GalleryTestCase):
+    def test_backends(self):
+        images = [os.path.join(self.folder, 'image.jpg')] + \
+            [os.path.join(self.folder, 'exif', name) for name in sorted(os.listdir(os.path.join(self.folder, 'exif')))]
+        before = [imageio.imread(readThumbnail(image, self.folder)) for image in images]
+        for backend in [wagmetagen.BACKEND_OPENCV, wagmetagen.BACKEND_PILLOW]:
+            stats = run(self.folder, '--backend', backend)
+            self.assertEqual(stats['Items skipped'], 0)
+            for image, expected in zip(images, before):
+                thumbnail = imageio.imread(readThumbnail(image, self.folder))
+                self.assertEqual(thumbnail.shape, expected.shape)
+                # averaging and bilinear scaling differ in the fine detail only
+                self.assertLess(numpy.mean((thumbnail.astype('float') - expected) ** 2), 100)
+
+    def test_mirrored(self):
+        # red on the left, mirrored by the EXIF orientation
+        image = os.path.join(self.folder, 'mirrored.jpg')
+        pixels = 255 * numpy.ones((300, 400, 3), numpy.uint8)
+        pixels[:, 0:100, 1:3] = 0
+        exif = PILImage.Exif()
+        exif[wagmetagen.EXIF_ORIENTATION] = 2
+        PILImage.fromarray(pixels).save(image, exif=exif.tobytes())
+        run(self.folder, '--previews', '200')
+        metaDir = wagmetagen.getMetaDir(image, self.folder)
+        # as imageio decodes it, with the red edge on the right
+        for tn in [imageio.imread(image), wagmetagen.decodeImage(image, 125), imageio.imread(readThumbnail(image, self.folder)),
+                   imageio.imread(os.path.join(metaDir, wagmetagen.PREVIEW_FILE.format(200)))]:
+            self.assertGreater(tn[tn.shape[0] // 2, 5, 1], 192)
+            self.assertLess(tn[tn.shape[0] // 2, -5, 1], 64)
+
+
+class TestVideos(GalleryTestCase):
+    def test_video_pipes(self):
+        album = os.path.join(self.folder, 'VideoGrouping')
+        broken = os.path.join(album, 'broken.mp4')
+        with open(broken, 'wb') as f:
+            f.write(b'\0' * 1024)
+        generator = wagmetagen.MetaGenerator()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ResourceWarning)
+            for name in sorted(os.listdir(album)):
+                path = os.path.join(album, name)
+                if wagmetagen.isvideo(path) and path != broken:
+                    wagmetagen.runTask(generator, wagmetagen.readFrame, path, os.stat(path))
+            with self.assertRaises(OSError):
+                wagmetagen.runTask(generator, wagmetagen.probeVideo, broken)
+            gc.collect()
+        # the pipes of ffmpeg are closed whether it is stopped early, has exited or has failed
+        self.assertEqual([str(warning.message) for warning in caught if warning.category is ResourceWarning], [])
+
+
+class TestStats(GalleryTestCase):
+    def test_stats(self):
+        statsPath = os.path.join(self.tmpDir, 'stats.json')
+        stats = run(self.folder, '--full', '--stats', 'json', '--stats-file', statsPath)
+        with open(statsPath, encoding='utf-8') as f:
+            report = json.load(f)
+        stages = report['stages']
+        # every album is scanned and generated once
+        self.assertEqual(stages[wagmetagen.STAGE_SCAN]['calls'],
+                         stages[wagmetagen.STAGE_ALBUM]['calls'])
+        # the decoder and the parsers share a single read of every image
+        self.assertGreater(stages[wagmetagen.STAGE_READ]['bytesRead'], 0)
+        self.assertEqual(stages[wagmetagen.STAGE_READ]['calls'], stages[wagmetagen.STAGE_DECODE]['calls'])
+        self.assertEqual(stages[wagmetagen.STAGE_IPTC]['bytesRead'], 0)
+        self.assertEqual(stages[wagmetagen.STAGE_WRITE]['bytesWritten'], stats['Bytes written'])
+        self.assertLessEqual(sum(stage['wall'] for stage in stages.values()), report['wall'])
+        self.assertLessEqual(len(stages[wagmetagen.STAGE_WRITE][wagmetagen.STAGE_SLOWEST]), wagmetagen.SLOWEST_FILES)
+        # without worker processes, there is no worker memory to tell
+        self.assertNotIn('Peak memory of a worker process (kB)', stats)
+        self.assertIsNone(report['peakWorkerMemory'])
+
+    def test_unchanged_reads(self):
+        album = os.path.join(self.folder, 'large')
+        os.makedirs(album)
+        for name in ['Nikon-D7000.JPG', 'Alcatel-ONETOUCH6012A.jpg']:
+            shutil.copy2(os.path.join(dataFolder, 'sources', name), album)
+        run(self.folder)
+        os.utime(os.path.join(album, 'Nikon-D7000.JPG'))
+        statsPath = os.path.join(self.tmpDir, 'stats.json')
+        run(self.folder, '--stats', 'json', '--stats-file', statsPath)
+        with open(statsPath, encoding='utf-8') as f:
+            stages = json.load(f)['stages']
+        # only the changed image is read in full, the metadata of the unchanged items
+        # of the regenerated albums is parsed from their headers
+        self.assertEqual(stages[wagmetagen.STAGE_READ]['calls'], 1)
+        self.assertLess(stages[wagmetagen.STAGE_EXIF]['bytesRead'] + stages[wagmetagen.STAGE_IPTC]['bytesRead'],
+                        os.path.getsize(os.path.join(album, 'Alcatel-ONETOUCH6012A.jpg')) // 4)
+
+
+@unittest.skipUnless(wagmetagen.canWatch, 'inotify_simple is not installed')
+class TestWatch(GalleryTestCase):
+    def test_watch(self):
+        album = os.path.join(self.folder, 'exif')
+        image = os.path.join(album, 'added.jpg')
+        # the worker processes are kept for the whole watch
+        for kwargs in [{}, {'jobs': 2, 'pack': True}]:
+            stop = threading.Event()
+            thread = threading.Thread(target=wagmetagen.MetaGenerator(**kwargs).watch, args=(
+                self.folder, stop))
+            with contextlib.redirect_stdout(io.StringIO()):
+                thread.start()
+                try:
+                    shutil.copy2(os.path.join(album, '1-no-meta.jpg'), image)
+                    self.assertTrue(waitForAlbumItem(album, image, self.folder, True))
+                    self.assertTrue(os.path.isfile(os.path.join(wagmetagen.getMetaDir(
+                        image, self.folder), wagmetagen.METADATA_FILE)))
+                    os.remove(image)
+                    self.assertTrue(waitForAlbumItem(album, image, self.folder, False))
+                finally:
+                    stop.set()
+                    thread.join()
+
+def main(argv=None):
+    if argv is None:
+        ourArgv = sys.argv[1:]
+    else:
+        ourArgv = argv
+    parser = argparse.ArgumentParser(
+        description='Runs metadata generator tests')
+    parser.add_argument('folder',
+                        help='folder with test data')
+    args = parser.parse_args(ourArgv)
+    global dataFolder
+    dataFolder = args.folder
+    sys.argv = sys.argv[0:1]
+    unittest.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,10 @@
 import argparse
+import hashlib
 import json
 import os
 import pty
+import shutil
+import struct
 import subprocess
 import sys
 import unittest
@@ -19,16 +22,20 @@ MEDIA_EXT = {
     '.m4v': 'video/mp4',
 }
 
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python', 'wagmetagen.py')
+
 testFolder = None
 cookie = None
 
 
-def call(path, decode=True, method='GET'):
+def call(path, decode=True, method='GET', gallery=None, accept=None):
     global cookie
     request = urllib.request.Request(
-        'http://localhost:8000/' + os.path.basename(testFolder) + '/wag.php' + urllib.parse.quote(path, safe='/'), method=method)
+        'http://localhost:8000/' + (gallery or os.path.basename(testFolder)) + '/wag.php' + urllib.parse.quote(path, safe='/'), method=method)
     if cookie is not None:
         request.add_header('Cookie', cookie)
+    if accept is not None:
+        request.add_header('Accept', accept)
     try:
         response = urllib.request.urlopen(request)
         cookie = response.getheader('Set-Cookie', None)
@@ -40,6 +47,40 @@ def call(path, decode=True, method='GET'):
     return (response.status, response.getheader('Content-Type', ''), data)
 
 
+def makeGallery(name, items, *args):
+    # a gallery next to the test folder, generated with the given options
+    folder = os.path.join(os.path.dirname(testFolder), name)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    shutil.copy2(os.path.join(testFolder, 'wag.php'), folder)
+    for item in items:
+        src = os.path.join(testFolder, item)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(folder, item))
+        else:
+            shutil.copy2(src, folder)
+    subprocess.run([sys.executable, GENERATOR, folder] + list(args), stdout=subprocess.DEVNULL, check=True)
+    return folder
+
+
+def getMetaDir(folder, path):
+    return os.path.join(folder, '.wag', hashlib.md5(path.encode('utf-8')).hexdigest())
+
+
+def readPackedThumbnail(folder, path):
+    with open(os.path.join(folder, '.wag', 'thumbnails.idx'), 'rb') as f:
+        index = f.read()
+    _, _, generation, count = struct.unpack_from('<4sIII', index)
+    key = bytes.fromhex(hashlib.md5(path.encode('utf-8')).hexdigest())
+    for i in range(count):
+        metaId, offset, length = struct.unpack_from('<16sQI', index, 16 + i * 28)
+        if metaId == key:
+            with open(os.path.join(folder, '.wag', 'thumbnails.{}.pack'.format(generation)), 'rb') as f:
+                f.seek(offset)
+                return generation, f.read(length)
+    return generation, None
+
+
 class TestPHP(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -228,6 +269,113 @@ class TestPHP(unittest.TestCase):
         self.assertEqual(res[0], 404)
 
 
+    def test_packed_thumbnail(self):
+        if self.isB2:
+            return
+        folder = makeGallery('test-packed', ['image.jpg'], '--pack')
+        self.addCleanup(shutil.rmtree, folder)
+        tnPath = os.path.join(getMetaDir(folder, 'image.jpg'), 'tn.jpg')
+        self.assertFalse(os.path.exists(tnPath))
+        generation, thumbnail = readPackedThumbnail(folder, 'image.jpg')
+        self.assertTrue(thumbnail.startswith(b'\xff\xd8'))
+        res = call('/api/media/' + os.path.relpath(tnPath, folder), decode=False, gallery='test-packed')
+        self.assertEqual(res[0], 200)
+        self.assertTrue(MEDIA_EXT['.jpg'] in res[1])
+        self.assertEqual(res[2], thumbnail)
+
+        # a changed item appends its thumbnail, which is served from the compacted pack
+        os.utime(os.path.join(folder, 'image.jpg'))
+        subprocess.run([sys.executable, GENERATOR, folder, '--pack', '--compact'], stdout=subprocess.DEVNULL, check=True)
+        compactedGeneration, compacted = readPackedThumbnail(folder, 'image.jpg')
+        self.assertEqual(compactedGeneration, generation + 1)
+        res = call('/api/media/' + os.path.relpath(tnPath, folder), decode=False, gallery='test-packed')
+        self.assertEqual(res[0], 200)
+        self.assertEqual(res[2], compacted)
+        res = call('/api/media/.wag/' + '0' * 32 + '/tn.jpg', decode=False, gallery='test-packed')
+        self.assertEqual(res[0], 404)
+
+    def test_listing(self):
+        if self.isB2:
+            return
+        # the copied folder keeps the time of the test data, so its listing is complete
+        folder = makeGallery('test-listing', ['exif'])
+        self.addCleanup(shutil.rmtree, folder)
+        album = os.path.join(folder, 'exif')
+        expected = [{'path': 'exif/' + name, 'type': 'medium'} for name in sorted(os.listdir(album))]
+        listingPath = os.path.join(getMetaDir(folder, 'exif'), 'listing.json')
+        with open(listingPath, encoding='utf-8') as f:
+            listing = json.load(f)
+        self.assertEqual(listing['mtimeNs'], os.stat(album).st_mtime_ns)
+        # an entry only the listing has tells whether it is served
+        ghost = {'path': 'exif/ghost.jpg', 'type': 'medium'}
+        listing['entries'].append(ghost)
+        with open(listingPath, 'w', encoding='utf-8') as f:
+            json.dump(listing, f)
+
+        res = call('/api/albums/exif', gallery='test-listing')
+        self.assertEqual(res[0], 200)
+        self.assertEqual(sorted(json.loads(res[2])['entries'], key=lambda entry: entry['path']),
+                         sorted(expected + [ghost], key=lambda entry: entry['path']))
+
+        # a folder changed since the listing is scanned
+        mtime = os.stat(album).st_mtime
+        os.utime(album, (mtime + 10, mtime + 10))
+        res = call('/api/albums/exif', gallery='test-listing')
+        self.assertEqual(res[0], 200)
+        self.assertEqual(sorted(json.loads(res[2])['entries'], key=lambda entry: entry['path']), expected)
+
+        # as is one without a listing
+        os.utime(album, (mtime, mtime))
+        os.remove(listingPath)
+        res = call('/api/albums/exif', gallery='test-listing')
+        self.assertEqual(res[0], 200)
+        self.assertEqual(sorted(json.loads(res[2])['entries'], key=lambda entry: entry['path']), expected)
+
+    def test_negotiation(self):
+        if self.isB2:
+            return
+        folder = makeGallery('test-formats', ['image.jpg'])
+        self.addCleanup(shutil.rmtree, folder)
+        metaDir = getMetaDir(folder, 'image.jpg')
+        # the negotiation only depends on the metadata and on which files exist
+        for ext in ['webp', 'avif']:
+            with open(os.path.join(metaDir, 'tn.' + ext), 'wb') as f:
+                f.write(ext.encode('utf-8'))
+        with open(os.path.join(metaDir, 'tn.jpg'), 'rb') as f:
+            jpeg = f.read()
+        metaPath = os.path.join(metaDir, 'meta.json')
+        with open(metaPath, encoding='utf-8') as f:
+            meta = json.load(f)
+
+        def negotiate(formats, accept):
+            meta['formats'] = formats
+            with open(metaPath, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            res = call('/api/media/' + os.path.relpath(os.path.join(metaDir, 'tn.jpg'), folder),
+                       decode=False, gallery='test-formats', accept=accept)
+            self.assertEqual(res[0], 200)
+            return res[1].split(';')[0], res[2]
+
+        preferred = ['image/avif', 'image/webp', 'image/jpeg']
+        self.assertEqual(negotiate(preferred, 'image/avif,image/webp,*/*'), ('image/avif', b'avif'))
+        self.assertEqual(negotiate(preferred, 'image/webp,*/*'), ('image/webp', b'webp'))
+        self.assertEqual(negotiate(preferred, 'IMAGE/WEBP'), ('image/webp', b'webp'))
+        # wildcards do not tell whether a format is decoded
+        self.assertEqual(negotiate(preferred, '*/*'), ('image/jpeg', jpeg))
+        self.assertEqual(negotiate(preferred, 'image/*'), ('image/jpeg', jpeg))
+        self.assertEqual(negotiate(preferred, None), ('image/jpeg', jpeg))
+        # refused formats
+        self.assertEqual(negotiate(preferred, 'image/avif;q=0,image/webp;q=0.8,*/*;q=0.5'), ('image/webp', b'webp'))
+        self.assertEqual(negotiate(preferred, 'image/webp; q=0, */*'), ('image/jpeg', jpeg))
+        # the order of the generator wins over the order of the client
+        self.assertEqual(negotiate(['image/webp', 'image/avif', 'image/jpeg'], 'image/avif,image/webp'),
+                         ('image/webp', b'webp'))
+        # only the listed formats are served, and only when their files exist
+        self.assertEqual(negotiate(['image/jpeg'], 'image/avif,image/webp'), ('image/jpeg', jpeg))
+        os.remove(os.path.join(metaDir, 'tn.avif'))
+        self.assertEqual(negotiate(preferred, 'image/avif'), ('image/jpeg', jpeg))
+
+
 def main(argv=None):
     if argv is None:
         ourArgv = sys.argv[1:]